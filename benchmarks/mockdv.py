@@ -0,0 +1,422 @@
+'''
+Local stand-in for the parts of the Dataverse API used by dv_coll_linker.
+
+Serves:
+
+* GET /api/search, with the per_page, start, subtree and
+  fq=dateSort:[start TO end] (or end}) parameters
+* GET /api/datasets/:persistentId/links
+* PUT /api/datasets/:persistentId/link/{alias}
+* DELETE /api/datasets/:persistentId/deleteLink/{alias}
+
+from an in-memory installation with a configurable number of datasets
+spread over a tree of collections. Requests can be slowed down by a fixed
+latency and can fail (HTTP 503) at random, to exercise retries.
+
+As in Dataverse, dateSort is the publication date (published_at), which
+doesn't change when a dataset is moved or edited, although updatedAt
+does.
+
+Run it on its own with:
+
+    python mockdv.py --datasets 10000 --port 8080
+
+or start it in a thread with MockDataverse(...).start().
+'''
+import argparse
+import bisect
+import datetime
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+from collections import Counter, OrderedDict
+
+TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
+ROOT = 'root'
+#Filtered result lists kept for paging through
+CACHESIZE = 64
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    '''
+    Threaded HTTP server (http.server.ThreadingHTTPServer is Python 3.7+)
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MockDataverse:
+    '''
+    In-memory Dataverse installation.
+
+    datasets : int
+        Number of datasets
+    collections : int
+        Number of top level collections
+    depth : int
+        Levels of sub-collections below each top level collection
+    branching : int
+        Number of sub-collections in each collection above the lowest level
+    latency : float
+        Seconds added to every response
+    error_rate : float
+        Fraction of requests which fail with HTTP 503
+    seed : int
+        Random seed, so that runs are repeatable
+    '''
+    #pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self, datasets:int=1000, collections:int=10, depth:int=1,
+                 branching:int=2, latency:float=0, error_rate:float=0,
+                 seed:int=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.parents = {}
+        level = []
+        for num in range(collections):
+            alias = f'coll{num}'
+            self.parents[alias] = ROOT
+            level.append(alias)
+        for _ in range(depth):
+            below = []
+            for parent in level:
+                for num in range(branching):
+                    alias = f'{parent}_{num}'
+                    self.parents[alias] = parent
+                    below.append(alias)
+            level = below
+        self.aliases = sorted(self.parents)
+        self.items = []
+        self.dates = []
+        self.links = set()
+        self.requests = Counter()
+        self.cache = OrderedDict()
+        self.server = None
+        self.serial = 0
+        self.start_date = datetime.datetime(2010, 1, 1)
+        self.add_datasets(datasets)
+
+    def add_datasets(self, count:int, when:datetime.datetime=None) -> None:
+        '''
+        Publishes {count} new datasets. They are dated {when}, or spread
+        evenly after the existing datasets if it isn't supplied.
+        '''
+        with self.lock:
+            for num in range(self.serial, self.serial + count):
+                if when is None:
+                    date = (self.start_date +
+                            datetime.timedelta(hours=num)).strftime(TIMEFMT)
+                else:
+                    date = when.strftime(TIMEFMT)
+                alias = self.aliases[num % len(self.aliases)]
+                self.items.append(self._record(num, alias, date))
+            self.serial += count
+            self.items.sort(key=lambda x: x['published_at'])
+            self.dates = [x['published_at'] for x in self.items]
+            self.cache.clear()
+
+    def remove_datasets(self, count:int) -> None:
+        '''
+        Deletes the {count} oldest datasets
+        '''
+        with self.lock:
+            del self.items[:count]
+            self.dates = [x['published_at'] for x in self.items]
+            self.cache.clear()
+
+    def move_datasets(self, alias:str, dest:str) -> list:
+        '''
+        Moves every dataset in collection {alias} to collection {dest}.
+        Returns their PIDs. As in Dataverse, updatedAt changes but
+        dateSort doesn't.
+        '''
+        now = datetime.datetime.now(datetime.timezone.utc).strftime(TIMEFMT)
+        with self.lock:
+            moved = [x for x in self.items if x['identifier_of_dataverse'] == alias]
+            for rec in moved:
+                rec.update(identifier_of_dataverse=dest, name_of_dataverse=dest.upper(),
+                           updatedAt=now)
+            self.cache.clear()
+        return [x['global_id'] for x in moved]
+
+    @staticmethod
+    def _record(num:int, alias:str, date:str) -> dict:
+        '''
+        Search API record, with the usual assortment of unused fields
+        '''
+        pid = f'doi:10.80240/FK2/MOCK{num:07d}'
+        return {'name': f'Mock dataset {num}',
+                'type': 'dataset',
+                'url': f'https://doi.org/{pid[4:]}',
+                'global_id': pid,
+                'description': 'A dataset which does not exist. ' * 4,
+                'published_at': date,
+                'publisher': alias,
+                'citationHtml': f'Mock, A., 2020, "Mock dataset {num}", {pid}',
+                'identifier_of_dataverse': alias,
+                'name_of_dataverse': alias.upper(),
+                'citation': f'Mock, A., 2020, "Mock dataset {num}", {pid}',
+                'storageIdentifier': f'file://10.80240/FK2/MOCK{num:07d}',
+                'keywords': ['mock'],
+                'subjects': ['Other'],
+                'fileCount': 1,
+                'versionId': num,
+                'versionState': 'RELEASED',
+                'majorVersion': 1,
+                'minorVersion': 0,
+                'createdAt': date,
+                'updatedAt': date,
+                'contacts': [{'name': 'Mock, A.', 'affiliation': ''}],
+                'authors': ['Mock, A.']}
+
+    def subtree(self, alias:str) -> set:
+        '''
+        Returns {alias} and the aliases of all its sub-collections
+        '''
+        found = {alias}
+        for child in self.aliases:
+            parent = self.parents[child]
+            while parent != ROOT:
+                if parent == alias:
+                    found.add(child)
+                    break
+                parent = self.parents[parent]
+        return found
+
+    def search(self, query:dict) -> list:
+        '''
+        Returns all datasets matching parsed search API parameters
+        '''
+        key = (tuple(query.get('subtree', ())), tuple(query.get('fq', ())))
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            lo, hi = 0, len(self.items)
+            for fquery in query.get('fq', ()):
+                field, _, value = fquery.partition(':')
+                if field != 'dateSort':
+                    continue
+                start, end = value[1:-1].split(' TO ')
+                if start != '*':
+                    lo = max(lo, bisect.bisect_left(self.dates, start))
+                if end != '*':
+                    cut = bisect.bisect_left if value.endswith('}') else bisect.bisect_right
+                    hi = min(hi, cut(self.dates, end))
+            found = self.items[lo:hi]
+            if 'subtree' in query:
+                aliases = set()
+                for alias in query['subtree']:
+                    aliases |= self.subtree(alias)
+                found = [x for x in found if x['identifier_of_dataverse'] in aliases]
+            self.cache[key] = found
+            if len(self.cache) > CACHESIZE:
+                self.cache.popitem(last=False)
+            return found
+
+    def collection_rows(self) -> list:
+        '''
+        Returns (id, alias, name) rows for every collection, as for
+        dv_coll_linker.monitor.populate_db
+        '''
+        return [(num, alias, alias.upper()) for num, alias in
+                enumerate([ROOT] + self.aliases, start=1)]
+
+    def handler(self) -> type:
+        '''
+        Returns a request handler class bound to this installation
+        '''
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            '''
+            Dataverse API request handler
+            '''
+            protocol_version = 'HTTP/1.1'
+            #Headers and body are separate writes, which Nagle's algorithm and
+            #delayed ACKs would hold up by ~40 ms on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args): #pylint: disable=arguments-differ
+                pass
+
+            def send(self, obj:dict, code:int=200, headers:dict=None):
+                '''
+                Sends a JSON response
+                '''
+                body = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def start(self, endpoint:str) -> bool:
+                '''
+                Counts the request and applies latency and errors. Returns
+                False if an error has been sent instead of a response.
+                '''
+                with mock.lock:
+                    mock.requests[endpoint] += 1
+                    fail = mock.random.random() < mock.error_rate
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if fail:
+                    mock.requests['errors'] += 1
+                    self.send({'status': 'ERROR', 'message': 'Service unavailable'},
+                              503, {'Retry-After': '0'})
+                    return False
+                return True
+
+            def link_target(self) -> (str, str):
+                '''
+                Returns the (pid, alias) of a link request
+                '''
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                return query.get('persistentId', [''])[0], url.path.rsplit('/', 1)[-1]
+
+            def do_GET(self): #pylint: disable=invalid-name
+                '''
+                Search API
+                '''
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/api/datasets/:persistentId/links':
+                    self.get_links()
+                    return
+                if url.path != '/api/search':
+                    self.send({'status': 'ERROR', 'message': 'Not found'}, 404)
+                    return
+                if not self.start('search'):
+                    return
+                query = urllib.parse.parse_qs(url.query)
+                per_page = min(1000, int(query.get('per_page', ['10'])[0]))
+                start = int(query.get('start', ['0'])[0])
+                found = mock.search(query)
+                self.send({'status': 'OK',
+                           'data': {'q': '*',
+                                    'total_count': len(found),
+                                    'start': start,
+                                    'spelling_alternatives': {},
+                                    'items': found[start:start+per_page],
+                                    'count_in_response': len(found[start:start+per_page])}})
+
+            def get_links(self):
+                '''
+                Collections a dataset is linked to
+                '''
+                if not self.start('links'):
+                    return
+                pid = self.link_target()[0]
+                with mock.lock:
+                    aliases = sorted(x[1] for x in mock.links if x[0] == pid)
+                self.send({'status': 'OK',
+                           'data': {f'dataverses that link to dataset {pid}':
+                                    [f'{x} (id 0)' for x in aliases]}})
+
+            def do_PUT(self): #pylint: disable=invalid-name
+                '''
+                Link a dataset
+                '''
+                if not self.start('link'):
+                    return
+                pid, alias = self.link_target()
+                with mock.lock:
+                    exists = (pid, alias) in mock.links
+                    mock.links.add((pid, alias))
+                if exists:
+                    self.send({'status': 'ERROR',
+                               'message': ('Can\'t link a dataset that has '
+                                           'already been linked to this dataverse')}, 403)
+                    return
+                self.send({'status': 'OK',
+                           'data': {'message': f'Dataset {pid} linked successfully to {alias}'}})
+
+            def do_DELETE(self): #pylint: disable=invalid-name
+                '''
+                Unlink a dataset
+                '''
+                if not self.start('unlink'):
+                    return
+                pid, alias = self.link_target()
+                with mock.lock:
+                    exists = (pid, alias) in mock.links
+                    mock.links.discard((pid, alias))
+                if not exists:
+                    self.send({'status': 'ERROR',
+                               'message': f'Dataset linking dataverse with alias {alias} '
+                                          'not found.'}, 404)
+                    return
+                self.send({'status': 'OK',
+                           'data': {'message': 'Link from Dataset deleted.'}})
+
+        return Handler
+
+    def start(self, host:str='127.0.0.1', port:int=0) -> str:
+        '''
+        Starts serving in a background thread. Returns the base URL.
+        '''
+        self.server = _Server((host, port), self.handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self) -> str:
+        '''
+        Base URL of the running server
+        '''
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self) -> None:
+        '''
+        Stops the server
+        '''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def parse_args() -> argparse.Namespace:
+    '''
+    Command line arguments for a stand-alone server
+    '''
+    parser = argparse.ArgumentParser(description='Mock Dataverse installation')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--datasets', type=int, default=1000)
+    parser.add_argument('--collections', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--branching', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every response')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                        help='Fraction of requests which fail with HTTP 503')
+    return parser.parse_args()
+
+def main():
+    '''
+    Runs a mock server until interrupted
+    '''
+    args = parse_args()
+    mock = MockDataverse(args.datasets, args.collections, args.depth, args.branching,
+                         args.latency, args.error_rate)
+    mock.start(args.host, args.port)
+    print(f'Serving {len(mock.items)} datasets in {len(mock.aliases)} '
+          f'collections at {mock.url}')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.stop()
+        print(dict(mock.requests))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+End-to-end benchmarks for dv_coll_linker, run against a local mock
+Dataverse installation (see mockdv.py) instead of a production server.
+
+For each installation size, the linker is run:
+
+full
+    Against an empty link database, so every study is harvested and
+    every link created
+incremental
+    With --incremental, after a further 1% of datasets have been published
+
+Each run is a separate process, so that its peak memory is its own. Wall
+time, the number of requests of each type and peak resident memory are
+reported for each run. Runs with the same settings are comparable with
+each other; absolute numbers depend on the machine.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000
+    python benchmarks/run_benchmarks.py --latency 0.02 -- --windowed -n 8
+
+Arguments after -- are passed on to dv_coll_linker.
+'''
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import mockdv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dv_coll_linker import app, monitor #pylint: disable=wrong-import-position
+
+PARENT = 'linkparent'
+COLUMNS = ['size', 'run', 'wall_s', 'search', 'link', 'unlink', 'errors',
+           'peak_rss_mb', 'studies', 'links']
+
+def parse_args() -> argparse.Namespace:
+    '''
+    Command line arguments
+    '''
+    parser = argparse.ArgumentParser(description=('Benchmark dv_coll_linker against '
+                                                  'a mock Dataverse installation'))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='Numbers of datasets. Default 1000 10000 100000')
+    parser.add_argument('--collections', type=int, default=10,
+                        help='Number of top level collections. Default 10')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='Levels of sub-collections. Default 1')
+    parser.add_argument('--branching', type=int, default=2,
+                        help='Sub-collections in each collection. Default 2')
+    parser.add_argument('--linked', type=int, default=2,
+                        help=('Number of top level collections linked to the '
+                              'parent collection. Default 2'))
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every response. Default 0')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0,
+                        help='Fraction of requests which fail with HTTP 503. Default 0')
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('linker_args', nargs='*',
+                        help='Extra dv_coll_linker arguments, after --')
+    return parser.parse_args()
+
+def child(linker_args:list) -> None:
+    '''
+    Runs dv_coll_linker once in this process and prints its wall time
+    and peak memory as JSON
+    '''
+    sys.argv = ['dv_coll_linker'] + linker_args
+    start = time.perf_counter()
+    app.main()
+    wall = time.perf_counter() - start
+    #ru_maxrss is in kB on Linux but bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    print(json.dumps({'wall_s': round(wall, 3), 'peak_rss_mb': round(rss / 1024, 1)}))
+
+def seed(mock:mockdv.MockDataverse, dbname:str, linked:int) -> None:
+    '''
+    Creates a link database with {linked} top level collections linked
+    to a parent collection, and the collection tree which would otherwise
+    be read from PostgreSQL
+    '''
+    conn = monitor.init(dbname)
+    rows = mock.collection_rows()
+    rows.append((len(rows) + 1, PARENT, PARENT.upper()))
+    ids = {x[1]: x[0] for x in rows}
+    tops = [x for x in mock.aliases if mock.parents[x] == mockdv.ROOT][:linked]
+    monitor.populate_db(conn, rows, [(ids[PARENT], PARENT, ids[x], x) for x in tops])
+    monitor.sync_collection_tree(conn, [(mockdv.ROOT, None), (PARENT, mockdv.ROOT)] +
+                                 list(mock.parents.items()))
+    conn.close()
+
+def run_linker(mock:mockdv.MockDataverse, workdir:str, extra:list) -> dict:
+    '''
+    Runs dv_coll_linker in a new process and returns its measurements,
+    along with the requests it made and the state of the link database
+    '''
+    before = mock.requests.copy()
+    dbname = os.path.join(workdir, 'dv_coll_linker.sqlite3')
+    linker_args = ['-u', mock.url, '-b', dbname, '-l', os.path.join(workdir, 'logs'),
+                   '-k', 'mock-api-key', '-e', 'warning'] + extra
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', '--']
+                          + linker_args, stdout=subprocess.PIPE, env=env,
+                          universal_newlines=True, check=True)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result.update({x: mock.requests[x] - before[x] for x in ('search', 'link',
+                                                             'unlink', 'errors')})
+    conn = monitor.init(dbname)
+    result['studies'] = conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+    result['links'] = conn.execute('SELECT COUNT(*) FROM links').fetchone()[0]
+    conn.close()
+    return result
+
+def bench(size:int, args:argparse.Namespace) -> list:
+    '''
+    Runs the full and incremental benchmarks for {size} datasets
+    '''
+    mock = mockdv.MockDataverse(size, args.collections, args.depth, args.branching,
+                                args.latency, args.error_rate)
+    mock.start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            seed(mock, os.path.join(workdir, 'dv_coll_linker.sqlite3'), args.linked)
+            results.append(dict(size=size, run='full',
+                                **run_linker(mock, workdir, args.linker_args)))
+            mock.add_datasets(max(1, size // 100),
+                              datetime.datetime.now(datetime.timezone.utc)
+                              .replace(tzinfo=None))
+            results.append(dict(size=size, run='incremental',
+                                **run_linker(mock, workdir, ['-i'] + args.linker_args)))
+    finally:
+        mock.stop()
+    return results
+
+def report(results:list) -> None:
+    '''
+    Prints results as a table
+    '''
+    widths = [max(len(x), *(len(str(r[x])) for r in results)) for x in COLUMNS]
+    print('  '.join(x.rjust(w) for x, w in zip(COLUMNS, widths)))
+    for res in results:
+        print('  '.join(str(res[x]).rjust(w) for x, w in zip(COLUMNS, widths)))
+
+def main():
+    '''
+    Runs the benchmarks
+    '''
+    args = parse_args()
+    if args.child:
+        child(args.linker_args)
+        return
+    results = []
+    for size in args.sizes:
+        results += bench(size, args)
+    report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as out:
+            json.dump(results, out, indent=2)
+
+if __name__ == '__main__':
+    main()
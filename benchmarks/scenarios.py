@@ -0,0 +1,170 @@
+'''
+End-to-end regression scenarios for dv_coll_linker, run against a local
+mock Dataverse installation (see mockdv.py).
+
+Each scenario sets up an installation and a link database, runs the
+linker in a separate process (as run_benchmarks.py does), changes the
+installation, runs the linker again and checks the links which result.
+Exits with status 1 if any scenario fails.
+
+Usage:
+
+    python benchmarks/scenarios.py
+    python benchmarks/scenarios.py scoped_emptied_subcollection
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+import mockdv
+import run_benchmarks
+from run_benchmarks import monitor, PARENT
+
+def setup(workdir:str, datasets:int=300, linked:int=1) -> mockdv.MockDataverse:
+    '''
+    Starts a mock installation with {linked} top level collections linked
+    to the parent collection, and creates its link database
+    '''
+    mock = mockdv.MockDataverse(datasets)
+    mock.start()
+    run_benchmarks.seed(mock, os.path.join(workdir, 'dv_coll_linker.sqlite3'), linked)
+    return mock
+
+def table_links(workdir:str) -> set:
+    '''
+    Returns the (pid, parent) pairs in the links table
+    '''
+    conn = monitor.init(os.path.join(workdir, 'dv_coll_linker.sqlite3'))
+    links = {x[:2] for x in monitor.fetch_links(conn)}
+    conn.close()
+    return links
+
+def scoped_emptied_subcollection(workdir:str) -> list:
+    '''
+    With --scoped, every study moved out of a linked sub-collection, leaving
+    it empty, is unlinked
+    '''
+    mock = setup(workdir)
+    try:
+        run_benchmarks.run_linker(mock, workdir, ['-s'])
+        moved = set(mock.move_datasets('coll0_1', 'coll5'))
+        #A change in the total forces a full harvest
+        mock.add_datasets(1)
+        run_benchmarks.run_linker(mock, workdir, ['-s'])
+        errors = []
+        if not moved:
+            errors.append('no datasets moved')
+        stale = {x for x in mock.links if x[0] in moved}
+        if stale:
+            errors.append(f'{len(stale)} moved studies still linked in Dataverse')
+        if table_links(workdir) != mock.links:
+            errors.append('links table differs from Dataverse')
+        return errors
+    finally:
+        mock.stop()
+
+def repair_keeps_manual_links(workdir:str) -> list:
+    '''
+    --verify --repair leaves links which a curator made by hand to a
+    linked parent collection, and --prune-unmanaged removes them
+    '''
+    mock = setup(workdir)
+    try:
+        conn = monitor.init(os.path.join(workdir, 'dv_coll_linker.sqlite3'))
+        #A second parent collection, with coll1 linked to it
+        conn.execute('INSERT INTO collections VALUES (?, ?, ?);', (999, 'other', 'OTHER'))
+        conn.execute('INSERT INTO children VALUES (?, ?, ?, ?);', (999, 'other', 2, 'coll1'))
+        conn.commit()
+        conn.close()
+        run_benchmarks.run_linker(mock, workdir, [])
+        #A study in coll0 linked to the second parent by hand
+        manual = (sorted(x for x in mock.links if x[1] == PARENT)[0][0], 'other')
+        mock.links.add(manual)
+        errors = []
+        run_benchmarks.run_linker(mock, workdir, ['--verify', '--repair'])
+        if manual not in mock.links:
+            errors.append('--repair removed a link made by hand')
+        run_benchmarks.run_linker(mock, workdir, ['--verify', '--repair', '--prune-unmanaged'])
+        if manual in mock.links:
+            errors.append('--prune-unmanaged left a link made by hand')
+        return errors
+    finally:
+        mock.stop()
+
+def incremental_moves_wait_for_full_sweep(workdir:str) -> list:
+    '''
+    A study moved into a linked collection isn't seen by an incremental
+    harvest, as moving it doesn't change dateSort, but is linked by the
+    next full harvest
+    '''
+    mock = setup(workdir)
+    try:
+        run_benchmarks.run_linker(mock, workdir, ['-i'])
+        moved = set(mock.move_datasets('coll5', 'coll0'))
+        run_benchmarks.run_linker(mock, workdir, ['-i'])
+        errors = []
+        early = {x for x in mock.links if x[0] in moved}
+        if early:
+            errors.append(f'{len(early)} moved studies linked without a full harvest; '
+                          'the mock dateSort should not change on a move')
+        run_benchmarks.run_linker(mock, workdir, ['-i', '--full-sweep', '0'])
+        if {x[0] for x in mock.links if x[0] in moved} != moved:
+            errors.append('moved studies not linked after a full harvest')
+        return errors
+    finally:
+        mock.stop()
+
+def checks_in_the_same_second(workdir:str) -> list:
+    '''
+    A second update check in the same second as the first (the status
+    timestamp has one second resolution) updates its status rather than
+    failing, and keeps its search snapshot
+    '''
+    mock = setup(workdir)
+    try:
+        run_benchmarks.run_linker(mock, workdir, [])
+    finally:
+        mock.stop()
+    conn = monitor.init(os.path.join(workdir, 'dv_coll_linker.sqlite3'))
+    try:
+        last_check, count = monitor.get_last_count(conn)
+        errors = []
+        try:
+            monitor.write_status(conn, last_check, count + 1)
+        except monitor.sqlite3.Error as err:
+            return [f'second status for {last_check} failed: {err}']
+        if monitor.get_last_count(conn) != (last_check, count + 1):
+            errors.append(f'status not updated: {monitor.get_last_count(conn)}')
+        if monitor.get_last_harvest(conn) != last_check:
+            errors.append('search snapshot lost')
+        if conn.execute('PRAGMA foreign_key_check;').fetchall():
+            errors.append('foreign key violations')
+        return errors
+    finally:
+        conn.close()
+
+SCENARIOS = [scoped_emptied_subcollection, repair_keeps_manual_links,
+             incremental_moves_wait_for_full_sweep, checks_in_the_same_second]
+
+def main():
+    '''
+    Runs the scenarios
+    '''
+    parser = argparse.ArgumentParser(description=('Run end-to-end dv_coll_linker '
+                                                  'scenarios against a mock Dataverse'))
+    parser.add_argument('names', nargs='*', help='Scenarios to run. Default: all')
+    args = parser.parse_args()
+    failed = False
+    for scenario in SCENARIOS:
+        if args.names and scenario.__name__ not in args.names:
+            continue
+        with tempfile.TemporaryDirectory() as workdir:
+            errors = scenario(workdir)
+        print(f'{"FAIL" if errors else "PASS"} {scenario.__name__}'
+              + ''.join(f'\n    {x}' for x in errors))
+        failed = failed or bool(errors)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
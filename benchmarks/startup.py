@@ -0,0 +1,103 @@
+'''
+Startup time benchmark for the dv_coll_linker command line tool.
+
+Times, in fresh interpreters:
+
+bare
+    python -c pass, the interpreter's own startup
+import
+    importing dv_coll_linker.app
+version
+    dv_coll_linker --version
+
+and checks that importing dv_coll_linker.app doesn't import any of the
+slow or optional modules which are only needed once a run starts. Exits
+with status 1 if one of them is imported or if importing the application
+takes longer than --budget milliseconds more than a bare interpreter, so
+it can be used as a regression check.
+
+Usage:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --budget 75
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Modules which must not be imported before they are needed
+LAZY = ('requests', 'urllib3', 'psycopg2', 'pkg_resources', 'cProfile', 'tracemalloc')
+
+COMMANDS = {'bare': ['-c', 'pass'],
+            'import': ['-c', 'import dv_coll_linker.app'],
+            'version': ['-m', 'dv_coll_linker.app', '--version']}
+
+def parse_args() -> argparse.Namespace:
+    '''
+    Command line arguments
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark dv_coll_linker startup time')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of times each command is timed. Default 10')
+    parser.add_argument('--budget', type=float, default=100,
+                        help=('Maximum median milliseconds importing dv_coll_linker.app '
+                              'may add to interpreter startup. Default 100'))
+    return parser.parse_args()
+
+def env() -> dict:
+    '''
+    Environment in which the repository version of dv_coll_linker is imported
+    '''
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT,
+                                                        os.environ.get('PYTHONPATH', '')]))
+
+def timeit(args:list, runs:int) -> list:
+    '''
+    Returns the wall times in ms of {runs} runs of python {args}
+    '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env(), check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def eager_imports() -> list:
+    '''
+    Returns the modules in LAZY which are imported by dv_coll_linker.app
+    '''
+    code = ('import sys, dv_coll_linker.app; '
+            f'print(" ".join(x for x in {LAZY!r} if x in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], env=env(), check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return out.stdout.split()
+
+def main():
+    '''
+    Runs the benchmark
+    '''
+    args = parse_args()
+    results = {name: timeit(cmd, args.runs) for name, cmd in COMMANDS.items()}
+    print(f'{"command":>8} {"min_ms":>8} {"median_ms":>10}')
+    for name, times in results.items():
+        print(f'{name:>8} {min(times):8.1f} {statistics.median(times):10.1f}')
+    failed = False
+    overhead = statistics.median(results['import']) - statistics.median(results['bare'])
+    print(f'Import overhead: {overhead:.1f} ms (budget {args.budget:.0f} ms)')
+    if overhead > args.budget:
+        print('FAIL: import overhead over budget')
+        failed = True
+    eager = eager_imports()
+    if eager:
+        print(f'FAIL: imported at startup: {", ".join(eager)}')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,25 @@ search API
 linker: Python implementation of linking and unlinking
 data sets
 
+session: shared, pooled HTTP session used by search and linker
+
+records: compact study records used in place of search API results,
+and an index of them by update time
+
 monitor: SQLite monitor of collection level linking.
 
+runlock: exclusive lock preventing overlapping runs on one link database
+
+planner: set-based calculation of the links to create and remove
+
+verify: checking (and repairing) the links table against Dataverse
+
+metrics: per-run phase timings, counts and HTTP latencies
+
+profiling: whole-run profiling for performance bug reports
+
+multi: updating several Dataverse installations from one configuration file
+
 app: Implementation of a standalone application which can
 run at intervals to emulate the collection linking feature.
 
@@ -34,6 +51,12 @@ will need to be populated manually. That is, the tables
 Similarly, if changes are made to the collection structure, such
 as an unlinked collection, if the PostgreSQL database cannot be read then
 the changes must be added to the SQLite database manually.
+
+Studies in the sub-collections of a linked collection are linked too,
+as they were in Dataverse 4.20. This requires the collection hierarchy,
+which is read from the PostgreSQL database into the `collection_tree`
+and `collection_closure` tables (see monitor.sync_collection_tree).
+Without it, only studies directly in a linked collection are linked.
 '''
 VERSION = (0, 5, 0)
 __version__ = '.'.join([str(x) for x in VERSION])
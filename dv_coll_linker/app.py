@@ -37,8 +37,9 @@ old links should automatically be removed if a study is deleted anyway, as it sh
 be purged from the PostgreSQL database. The easiest way to do this is to schedule it
 to run at regular intervals, such as by using crontab or the windows scheduler.
 
- There are other ways to daemonize, but this is supposed to be a stopgap and not a
- permanent solution, so they have not been implemented.
+ Alternatively, use --daemonize to keep the process running and check for
+ updates every --interval minutes, which avoids repeating the start up work
+ on every check.
 
 4. Unlinking code is commented out in the code below. See also linker.unlink.
 '''
@@ -48,12 +49,22 @@ import datetime
 import logging
 import logging.handlers
 import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
 import traceback
 
 import dv_coll_linker
-from dv_coll_linker import linker
+from dv_coll_linker import metrics
 from dv_coll_linker import monitor
-from dv_coll_linker import search
+from dv_coll_linker import planner
+from dv_coll_linker import runlock
+#linker, search and session import requests, and profiling imports the
+#profilers. They are slow to import, so they are imported where they are
+#used, and --help and --version return quickly.
+#pylint: disable=import-outside-toplevel
 
 #FORMATTER = logging.Formatter(('%(asctime)s - %(levelname)s - %(name)s - '
 #                               '%(funcName)s - %(message)s'))
@@ -62,8 +73,12 @@ FORMATTER = logging.Formatter(('{asctime} - {levelname} - {name} - '
                                '{funcName} - {message}'), style='{')
 #logging no longer explicitly set
 #LEVEL = logging.INFO
+LOGGER = logging.getLogger(__name__)
 TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
 DEFAULTDATE = '0001-01-01T00:00:00Z' #publishing predating this is unlikely
+INCREMENTAL_OVERLAP = datetime.timedelta(days=1)
+#Completed operations are marked done in the journal in batches of this size
+JOURNAL_BATCH = 100
 
 def produce_level(inval:str):
     '''
@@ -147,14 +162,133 @@ def argument_parser() -> argparse.ArgumentParser:
                               'Default = warning '),
                         dest = 'level',
                         default='warning')
-    ##Do I really want to do it this way, or do I just add it to crontab? No
-    #parser.add_argument('-z', '--daemonize',
-    #                    help=('Run as daemon'),
-    #                    action='store_true')
-    #parser.add_argument('-t', '--interval',
-    #                    help=('Update check interval in minutes if daemonized. '
-    #                          'Default: 10'),
-    #                    default=10)
+    parser.add_argument('-n', '--workers',
+                        help=('Number of concurrent requests to the Dataverse '
+                              'installation when harvesting and linking. Default 4'),
+                        type=int,
+                        default=4)
+    parser.add_argument('-q', '--rate',
+                        help=('Maximum average requests per second to the Dataverse '
+                              'installation. Default 0 (unlimited)'),
+                        type=float,
+                        default=0)
+    parser.add_argument('-a', '--retries',
+                        help=('Number of times a throttled, unavailable or failed request '
+                              'is retried. Retry-After headers are honoured, up to a '
+                              'pause of 60 seconds. Default 5'),
+                        type=int,
+                        default=5)
+    parser.add_argument('-i', '--incremental',
+                        help=('Only harvest studies released since the last check, with '
+                              'a full harvest every --full-sweep hours or whenever the '
+                              'number of studies drops. Studies moved between collections, '
+                              'and edits without a new major version (unless using '
+                              '--pg-harvest), are only picked up by the full harvest.'),
+                        action='store_true')
+    parser.add_argument('-f', '--full-sweep',
+                        help=('Hours between full harvests when using --incremental. '
+                              'Default 24'),
+                        dest='full_sweep',
+                        type=float,
+                        default=24)
+    parser.add_argument('-g', '--pg-harvest',
+                        help=('Read the list of studies directly from the Dataverse '
+                              'PostgreSQL database instead of the search API. Falls back '
+                              'to the search API if the database is unavailable.'),
+                        dest='pg_harvest',
+                        action='store_true')
+    parser.add_argument('-s', '--scoped',
+                        help=('Only harvest studies in linked (child) collections and '
+                              'their sub-collections, instead of the whole installation.'),
+                        action='store_true')
+    parser.add_argument('--no-subcollections',
+                        help=('Only link studies directly in each linked collection, '
+                              'not those in its sub-collections.'),
+                        dest='subcollections',
+                        action='store_false')
+    parser.add_argument('--windowed',
+                        help=('Split full harvests of the whole installation into '
+                              'dateSort windows of at most --window-size studies, '
+                              'fetched in parallel, instead of paging through all '
+                              'studies at once.'),
+                        action='store_true')
+    parser.add_argument('--window-size',
+                        help=('Maximum number of studies in a date window. '
+                              'Default 1000'),
+                        dest='window_size',
+                        type=int,
+                        default=1000) #search.WINDOWSIZE
+    parser.add_argument('--keep-snapshots',
+                        help=('Number of search result snapshots to keep in the '
+                              'link database. Default 3'),
+                        dest='keep_snapshots',
+                        type=int,
+                        default=3)
+    parser.add_argument('--keep-status',
+                        help=('Days of update check records to keep in the link '
+                              'database. Default 30'),
+                        dest='keep_status',
+                        type=float,
+                        default=30)
+    parser.add_argument('-z', '--daemonize',
+                        help=('Keep running, checking for updates every --interval '
+                              'minutes, instead of exiting after one check. Stops '
+                              'cleanly on SIGTERM or SIGINT.'),
+                        action='store_true')
+    parser.add_argument('-t', '--interval',
+                        help=('Update check interval in minutes if daemonized. '
+                              'Default: 10'),
+                        type=float,
+                        default=10)
+    parser.add_argument('--metrics-file',
+                        help=('Write the metrics for each update check to this file '
+                              'in the Prometheus text format, eg, for the node '
+                              'exporter textfile collector. Metrics are always '
+                              'stored in the run_metrics table of the link database.'),
+                        dest='metrics_file')
+    parser.add_argument('--verify',
+                        help=('Instead of updating links, check every link in the link '
+                              'database against the Dataverse installation, --workers '
+                              'studies at a time, and write a drift report to the log '
+                              'directory.'),
+                        action='store_true')
+    parser.add_argument('--repair',
+                        help=('With --verify, recreate missing links and track required '
+                              'links made outside the linker. Other links made outside '
+                              'the linker are only reported.'),
+                        action='store_true')
+    parser.add_argument('--prune-unmanaged',
+                        help=('With --verify --repair, also remove links to linked parent '
+                              'collections which the linker didn\'t make and which '
+                              'aren\'t required, such as links made by hand.'),
+                        dest='prune_unmanaged',
+                        action='store_true')
+    parser.add_argument('--lock-wait',
+                        help=('Seconds to wait for another run using the same link '
+                              'database to finish before giving up. Default 0 (exit '
+                              'immediately)'),
+                        dest='lock_wait',
+                        type=float,
+                        default=0)
+    parser.add_argument('--profile',
+                        help=('Profile the run, writing a pstats file and a text '
+                              'summary of the slowest functions to the log directory.'),
+                        action='store_true')
+    parser.add_argument('--profile-memory',
+                        help=('As --profile, also sampling memory use at the start '
+                              'and end of each phase. Much slower.'),
+                        dest='profile_memory',
+                        action='store_true')
+    parser.add_argument('-c', '--config',
+                        help=('Update several Dataverse installations, as listed in '
+                              'this configuration file, in parallel. Other options '
+                              'except --parallel are ignored. See the documentation '
+                              'for the file format.'))
+    parser.add_argument('--parallel',
+                        help=('With --config, maximum number of installations updated '
+                              'at once. Default 4'),
+                        type=int,
+                        default=4)
     parser.add_argument('-v','--version', action='version',
                         version='%(prog)s '+dv_coll_linker.__version__,
                         help='Show version number and exit')
@@ -189,104 +323,521 @@ def rotating_logger(path:str, level:int, fname='dv_coll_linker.log') -> logging.
     logger.setLevel(level)
     return logger
 
-def main():
+def harvest(conn, last_check:str, pages, seen:set, aliases:set=None):
     '''
-    Primary
+    Generator which stores each page of search results as part of the
+    search snapshot, then passes the records on one at a time for
+    monitor.add_studies.
+
+    conn : sqlite3.Connection
+        Link database connection
+    last_check : str
+        Timestamp of this harvest
+    pages : iterable
+        Lists of search API records, such as from search.iter_pages
+    seen : set
+        PIDs of all passed records are added to this set
+    aliases : set
+        If supplied, the collection aliases of all passed records are
+        added to this set
     '''
-    args = argument_parser().parse_args()
-    args.level = produce_level(args.level)
-    os.makedirs(os.path.split(os.path.expanduser(args.dbname))[0], exist_ok=True)
-    os.makedirs(os.path.expanduser(args.log), exist_ok=True)
-    mainlog = rotating_logger(args.log, args.level)
-    #mainlog = console_logger(LEVEL)
+    for page in pages:
+        monitor.write_search_data(conn, last_check, page, commit=False)
+        for rec in page:
+            seen.add(rec['global_id'])
+            if aliases is not None:
+                aliases.add(rec['identifier_of_dataverse'])
+            yield rec
+
+def run_ops(conn, op:str, links:list, url:str, key:str,
+            workers:int=1, sess=None) -> list:
+    '''
+    Performs journaled link or unlink operations, marking them done in the
+    journal and applying them to the links table every JOURNAL_BATCH
+    operations, so an interrupted run loses very little work. Returns
+    lists of the links successfully created or removed and of the links
+    not attempted because the circuit breaker opened; those are left
+    pending in the journal for the next run.
+
+    op : str
+        'link' or 'unlink'
+    links : list
+        (pid, parent, child) links already recorded with
+        monitor.journal_ops
+    '''
+    from dv_coll_linker import linker
+    func = linker.batch_link if op == 'link' else linker.batch_unlink
+    finished = []
+    def record(link, ok):
+        finished.append((link, ok))
+        if len(finished) >= JOURNAL_BATCH:
+            monitor.complete_ops(conn, op, finished)
+            finished.clear()
+    results = func(links, url, key, workers=workers, session=sess, callback=record)
+    monitor.complete_ops(conn, op, finished)
+    return [link for link, ok in results if ok], [link for link, ok in results if ok is None]
+
+def resume_ops(conn, url:str, key:str, workers:int=1, sess=None,
+               mets:metrics.Metrics=None) -> bool:
+    '''
+    Performs any link and unlink operations left pending in the journal by
+    an interrupted run. Returns True if there were any.
+    '''
+    if mets is None:
+        mets = metrics.Metrics()
+    links = monitor.pending_ops(conn, 'link')
+    unlinks = monitor.pending_ops(conn, 'unlink')
+    if not links and not unlinks:
+        return False
+    LOGGER.warning('Resuming %s link and %s unlink operations from an interrupted run',
+                   len(links), len(unlinks))
+    with mets.phase('resume'):
+        created, deferred = run_ops(conn, 'link', links, url, key, workers, sess)
+        removed, unlinks_deferred = run_ops(conn, 'unlink', unlinks, url, key, workers, sess)
+    deferred += unlinks_deferred
+    mets.inc('links_resumed', len(created) + len(removed))
+    mets.inc('resume_failed', len(links) + len(unlinks) - len(created) - len(removed)
+             - len(deferred))
+    mets.inc('ops_deferred', len(deferred))
+    LOGGER.info('Resumed: %s links created, %s links removed', len(created), len(removed))
+    return True
+
+def execute_plan(conn, plan:planner.LinkPlan, url:str, key:str,
+                 workers:int=1, sess=None, mets:metrics.Metrics=None) -> tuple:
+    '''
+    Creates and removes the links in a planner.LinkPlan in the Dataverse
+    installation at {url}, recording the results in the links table.
+    Returns lists of the links successfully created and removed.
+
+    The operations are written to the journal before any are performed,
+    so that if the run is interrupted the next one can finish them with
+    resume_ops. The same goes for operations abandoned because the circuit
+    breaker opened.
+
+    workers : int
+        Maximum number of concurrent link or unlink requests
+    sess : requests.Session
+        Session shared by all requests
+    mets : metrics.Metrics
+        Link and unlink times and counts are recorded here, if supplied
+    '''
+    if mets is None:
+        mets = metrics.Metrics()
+    #Rows for a study and parent which are still to be linked are only
+    #tracked once the link exists
+    pending = {x[:2] for x in plan.create}
+    monitor.add_links(conn, [x for x in plan.track if x[:2] not in pending])
+    monitor.remove_links(conn, plan.untrack)
+    monitor.journal_ops(conn, 'link', plan.create)
+    monitor.journal_ops(conn, 'unlink', plan.remove)
+    LOGGER.info('Creating %s links', len(plan.create))
+    with mets.phase('link'):
+        created, deferred = run_ops(conn, 'link', plan.create, url, key, workers, sess)
+        done = {x[:2] for x in created}
+        monitor.add_links(conn, [x for x in plan.track if x[:2] in done])
+    mets.inc('links_created', len(created))
+    mets.inc('links_failed', len(plan.create) - len(created) - len(deferred))
+    mets.inc('ops_deferred', len(deferred))
+
+    #Unlink and remove old links from deleted collections
+    with mets.phase('unlink'):
+        removed, deferred = run_ops(conn, 'unlink', plan.remove, url, key, workers, sess)
+    mets.inc('links_removed', len(removed))
+    mets.inc('unlinks_failed', len(plan.remove) - len(removed) - len(deferred))
+    mets.inc('ops_deferred', len(deferred))
+    LOGGER.info('Removed %s links from links table', len(removed))
+    return created, removed
+
+class LinkerState:
+    '''
+    Everything which can be kept between update checks: the link database
+    connection, the HTTP session, the PostgreSQL connection and the
+    planner's study and link indexes.
 
-    #create database if if doesn't exist
-    conn = monitor.init(os.path.expanduser(args.dbname))
+    In daemon mode the same LinkerState is used for every check, so only
+    the first one pays for initialization and loading the indexes.
+    '''
+    def __init__(self, args:argparse.Namespace):
+        from dv_coll_linker import session
+        self.args = args
+        #create database if if doesn't exist
+        self.conn = monitor.init(os.path.expanduser(args.dbname))
+        #one pooled session for every call to the Dataverse installation
+        self.session = session.make_session(max(args.workers, session.POOLSIZE),
+                                            session.RequestScheduler(rate=args.rate,
+                                                                     burst=args.workers,
+                                                                     retries=args.retries))
+        self.pconn = None
+        self.family_tree = None
+        self.index = None
+        self.links = None
+        #True once the studies table is known to match the last harvest
+        self.synced = False
+        #profiling.Profiler, if the run is being profiled
+        self.profiler = None
+
+    def pg_data(self) -> (list, list):
+        '''
+        Returns collection and children data from the Dataverse PostgreSQL
+        database, reconnecting if required.
+        '''
+        args = self.args
+        if self.pconn is None or self.pconn.closed:
+            self.pconn = monitor.pg_connect(args.dvdbname, args.user, args.password,
+                                            args.dbhost, args.port)
+        if self.pconn is None:
+            return None, None
+        return monitor.get_pg_data(args.dvdbname, args.user, args.password,
+                                   args.dbhost, args.port, pconn=self.pconn)
+
+    def pg_tree(self) -> list:
+        '''
+        Returns the collection ownership tree from the Dataverse PostgreSQL
+        database, or None if it isn't connected.
+        '''
+        if self.pconn is None or self.pconn.closed:
+            return None
+        return monitor.get_pg_tree(self.pconn)
+
+    def invalidate(self) -> None:
+        '''
+        Discards cached indexes, forcing them to be reloaded from the database
+        '''
+        self.family_tree = None
+        self.index = None
+        self.links = None
+        self.synced = False
+
+    def plan(self) -> planner.LinkPlan:
+        '''
+        Returns the current LinkPlan, loading any missing indexes
+        '''
+        family_tree = monitor.fetch_parent_child_collections(self.conn)
+        if family_tree != self.family_tree:
+            self.family_tree = family_tree
+            self.index = None
+        if self.index is None:
+            self.index = monitor.fetch_study_index(self.conn, self.args.subcollections)
+        if self.links is None:
+            self.links = monitor.fetch_links(self.conn)
+        return planner.plan_links(self.family_tree, self.index, self.links)
+
+    def apply(self, plan:planner.LinkPlan, created:list, removed:list) -> None:
+        '''
+        Updates the cached links to match an executed plan
+        '''
+        failed = {x[:2] for x in plan.create} - {x[:2] for x in created}
+        self.links |= {x for x in plan.track if x[:2] not in failed} | set(created)
+        self.links -= set(plan.untrack) | set(removed)
+
+    def close(self) -> None:
+        '''
+        Closes all connections
+        '''
+        self.conn.close()
+        self.session.close()
+        if self.pconn is not None and not self.pconn.closed:
+            self.pconn.close()
+
+def _run_cycle(state:LinkerState, mets:metrics.Metrics) -> None:
+    '''
+    Performs a single update check, recording measurements in {mets}
+    '''
+    from dv_coll_linker import search
+    args = state.args
+    conn = state.conn
+    sess = state.session
 
-    #is debugging
-    #cursor = conn.cursor()
-    #cursor.execute('DELETE FROM raw_data')
-    #cursor.execute('DELETE FROM status')
+    #Finish the work of an interrupted run before planning anything new
+    if resume_ops(conn, args.url, args.key, args.workers, sess, mets):
+        state.links = None
 
     #Populate with data if running on server, otherwise nothing
-    try:
-        collections, children = monitor.get_pg_data(args.dvdbname, args.user,
-                                                    args.password, args.dbhost,
-                                                    args.port)
+    with mets.phase('pg_read'):
+        collections, children = state.pg_data()
         if collections:
             monitor.populate_db(conn, collections, children)
+        tree = state.pg_tree()
+        if tree:
+            changed = monitor.sync_collection_tree(conn, tree)
+            if any(changed.values()):
+                #Studies may have moved in or out of linked sub-collections
+                state.index = None
+
+    #Get last count
+    date, count = monitor.get_last_count(conn)
+    LOGGER.info('Last count: %s', count)
+    if not date:
+        date = DEFAULTDATE
+
+    #Check to see if we need to update
+    with mets.phase('count'):
+        newcount = search.get_total_records(args.url, session=sess)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    newdate = now.strftime(TIMEFMT)
+    LOGGER.debug('count: %s,  newdate: %s, date: %s',
+                 count, newdate, date)
+
+    if args.incremental:
+        #Deletions can only be detected by a full sweep
+        last_harvest = monitor.get_last_harvest(conn)
+        full = (not last_harvest or newcount < count or
+                now - datetime.datetime.strptime(last_harvest, TIMEFMT) >=
+                datetime.timedelta(hours=args.full_sweep))
+    else:
+        full = newcount != count #!= or >? I suppose it's possible that it can shrink
+
+    purged = 0
+    counts = {'inserted': 0, 'updated': 0}
+    scope = None
+    orphans = None
+    if args.scoped:
+        scope = {x[1] for x in monitor.fetch_parent_child_collections(conn)}
+        #Links of studies purged from a scoped harvest, which may have moved
+        #out of scope rather than been deleted, so must be unlinked explicitly
+        orphans = []
+        LOGGER.info('Harvest limited to %s', scope)
+        monitor.forget_harvested_scopes(conn, scope)
+
+    def source(since=None):
+        if args.pg_harvest and state.pconn is not None and not state.pconn.closed:
+            LOGGER.info('Harvesting studies from PostgreSQL')
+            return 'pg_harvest', monitor.iter_pg_pages(state.pconn, since)
+        if scope is None and args.windowed and not since:
+            return 'search', search.iter_window_pages(args.url, workers=args.workers,
+                                                      session=sess,
+                                                      max_size=args.window_size)
+        if scope is None:
+            return 'search', search.iter_pages(args.url, workers=args.workers,
+                                               session=sess, since=since)
+        return 'search', search.iter_subtree_pages(sorted(scope), args.url,
+                                                   workers=args.workers,
+                                                   session=sess, since=since)
+
+    def pages(since=None):
+        #Fetching is timed separately from ingest, which consumes the pages
+        phase, found = source(since)
+        return mets.iter_pages(found, phase, exclude='ingest')
+
+    mets.inc('full_harvest', int(full))
+    if full:
+        LOGGER.info('Total number of new records: %s', newcount)
+        #if we had to download, we should save the data set
+        #status has to come first because it has the primary key. It is
+        #committed with the studies by add_studies, so a failed harvest
+        #leaves the previous count and the next check harvests again
+        monitor.write_status(conn, newdate, newcount, commit=False)
+        monitor.record_harvested_scopes(conn, scope if scope is not None else
+                                        {x[1] for x in
+                                         monitor.fetch_parent_child_collections(conn)},
+                                        commit=False)
+        seen = set()
+        #A sub-collection emptied since the last harvest has no records
+        #in this one, but its old studies must still be purged
+        harvested = (None if scope is None else
+                     monitor.fetch_subtree_aliases(conn, scope))
+        with mets.phase('ingest'):
+            counts = monitor.add_studies(conn, harvest(conn, newdate, pages(),
+                                                       seen, harvested))
+        #Strip nonexistent studies out just to keep things current.
+        with mets.phase('purge'):
+            purged = monitor.purge_nonexistent(conn, seen, harvested, orphans)
+    elif args.incremental:
+        #Overlap the previous check so clock differences can't lose records
+        since = (datetime.datetime.strptime(date, TIMEFMT) -
+                 INCREMENTAL_OVERLAP).strftime(TIMEFMT)
+        LOGGER.info('Harvesting records changed since %s', since)
+        #Only advanced if the harvest succeeds, as with a full harvest
+        monitor.write_status(conn, newdate, newcount, commit=False)
+        with mets.phase('ingest'):
+            counts = monitor.add_studies(conn, (rec for page in pages(since)
+                                                for rec in page))
+    elif not state.synced:
+        with mets.phase('purge'):
+            purged = monitor.purge_nonexistent(conn, monitor.iter_search_data(conn),
+                                               scope if scope is None else
+                                               monitor.fetch_subtree_aliases(conn, scope),
+                                               orphans)
+    if scope is not None and not full:
+        #Newly linked collections have never been harvested
+        missing = scope - monitor.fetch_harvested_scopes(conn)
+        if missing:
+            LOGGER.info('Harvesting new collections %s', missing)
+            found = search.iter_subtree_pages(sorted(missing), args.url,
+                                              workers=args.workers, session=sess)
+            #Committed with the studies, as with write_status
+            monitor.record_harvested_scopes(conn, missing, commit=False)
+            with mets.phase('ingest'):
+                new = monitor.add_studies(conn, (rec for page in
+                                                 mets.iter_pages(found, exclude='ingest')
+                                                 for rec in page))
+            counts = {x: counts[x] + new.get(x, 0) for x in counts}
+    #Every check adds run metrics and journal rows, so prune every check,
+    #not only after full harvests
+    with mets.phase('prune'):
+        monitor.prune(conn, args.keep_snapshots, args.keep_status)
+    for name, value in counts.items():
+        mets.inc(f'studies_{name}', value)
+    mets.inc('studies_purged', purged)
+    state.synced = True
+    if counts['inserted'] or counts['updated'] or purged:
+        state.index = None
+    if purged:
+        #purged studies take their links with them
+        state.links = None
+
+    #And now the magic happens
+    #Checking by time doesn't work if collections are deleted, so the
+    #plan compares every link that should exist with those that do
+    with mets.phase('plan'):
+        plan = state.plan()
+        if orphans:
+            #One unlink for each study and parent collection
+            pairs = {x[:2] for x in plan.remove}
+            orphans = {x[:2]: x for x in orphans if x[:2] not in pairs}
+            LOGGER.info('Unlinking %s links of studies no longer in scope', len(orphans))
+            plan = plan._replace(remove=sorted(plan.remove + list(orphans.values())))
+    state.apply(plan, *execute_plan(conn, plan, args.url, args.key, args.workers,
+                                    sess, mets))
+    conn.commit()
+
+def run_cycle(state:LinkerState) -> metrics.Metrics:
+    '''
+    Performs a single update check: harvests changed studies, then
+    creates and removes links as required. Returns the check's metrics.
+
+    Phase times, counts and HTTP request latencies for the check are
+    written to the run_metrics table and, if --metrics-file was given,
+    to a Prometheus node exporter textfile.
+    '''
+    mets = metrics.Metrics()
+    run_start = datetime.datetime.fromtimestamp(mets.started,
+                                                datetime.timezone.utc).strftime(TIMEFMT)
+    state.session.metrics = mets
+    if state.profiler is not None:
+        mets.hook = state.profiler.mark
+    try:
+        _run_cycle(state, mets)
+        mets.success = True
+    except Exception:
+        mets.success = False
+        state.conn.rollback()
+        #Links made before the failure are in the links table but not the cache
+        state.links = None
+        raise
+    finally:
+        state.session.metrics = None
+        LOGGER.info('Phase times: %s', ', '.join(f'{name} {value:.2f} s' for name, value
+                                                  in sorted(mets.phases.items())))
+        LOGGER.info('Counts: %s', mets.counters)
+        try:
+            monitor.write_run_metrics(state.conn, run_start, mets.rows())
+            if state.args.metrics_file:
+                mets.write_textfile(state.args.metrics_file)
+        except (OSError, sqlite3.Error):
+            LOGGER.exception('Unable to record run metrics')
+    return mets
+
+def run_verify(state:LinkerState) -> None:
+    '''
+    Checks the links table against the links in the Dataverse installation,
+    writing a drift report to the log directory and, if requested,
+    repairing the drift.
+    '''
+    from dv_coll_linker import verify
+    args = state.args
+    report = os.path.join(os.path.expanduser(args.log),
+                          datetime.datetime.now().strftime('drift-%Y%m%dT%H%M%S.csv'))
+    drift = verify.verify_links(state.conn, args.url, args.key, args.workers,
+                                state.session, fix=args.repair, report=report,
+                                recursive=args.subcollections,
+                                prune_unmanaged=args.prune_unmanaged)
+    if any(drift):
+        LOGGER.warning('Links drifted from Dataverse; see %s', report)
+
+def daemon(state:LinkerState, interval:float) -> None:
+    '''
+    Runs update checks every {interval} minutes until SIGTERM or SIGINT
+    is received. A check which is in progress when the signal arrives is
+    allowed to finish. Failed checks are logged and do not stop the daemon.
+    '''
+    stop = threading.Event()
+    def handler(signum, frame): #pylint: disable=unused-argument
+        LOGGER.warning('Received signal %s; stopping', signum)
+        stop.set()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+    LOGGER.info('Running as daemon; interval %s minutes', interval)
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            run_cycle(state)
+        except Exception: #pylint: disable=broad-except
+            LOGGER.exception('Update check failed')
+            state.conn.rollback()
+            state.invalidate()
+        LOGGER.info('Update check took %.1f s', time.monotonic() - start)
+        stop.wait(max(0, interval * 60 - (time.monotonic() - start)))
+    LOGGER.info('Daemon stopped')
+
+def setup(args:argparse.Namespace) -> logging.Logger:
+    '''
+    Creates the link database and log directories and starts logging
+    to the log directory. Returns the logger.
+    '''
+    args.level = produce_level(args.level)
+    os.makedirs(os.path.split(os.path.expanduser(args.dbname))[0], exist_ok=True)
+    os.makedirs(os.path.expanduser(args.log), exist_ok=True)
+    return rotating_logger(args.log, args.level)
 
-        #get link relationships
-        family_tree = monitor.fetch_parent_child_collections(conn)
-
-        #Get last count
-        date, count = monitor.get_last_count(conn)
-        mainlog.info('Last count: %s', count)
-        if not date:
-            date = DEFAULTDATE
-
-        #Check to see if we need to update
-        newcount = search.get_total_records(args.url)
-        newdate = datetime.datetime.now().strftime(TIMEFMT)
-        mainlog.debug('count: %s,  newdate: %s, date: %s',
-                     count, newdate, date)
-
-        if newcount != count: #!= or >? I suppose it's possible that it can shrink
-            mainlog.info('Total number of new records: %s', newcount)
-            allrecs = search.get_all_recs(args.url)
-            #if we had to download, we should save the data set
-            #status has to come first because it has the primary key
-            monitor.write_status(conn, newdate, newcount)
-            monitor.write_search_data(conn, newdate, allrecs)
-            #Update the list of all studies in the Dataverse installation
-            for rec in allrecs['data']['items']:
-                monitor.add_single_study(conn, **rec)
-            #Strip nonexistent studies out just to keep things current
+def main():
+    '''
+    Primary
+    '''
+    args = argument_parser().parse_args()
+    if args.config:
+        from dv_coll_linker import multi
+        sys.exit(multi.run_config(args.config, args.parallel))
+    mainlog = setup(args)
+    #mainlog = console_logger(LEVEL)
+
+    lock = runlock.RunLock(f'{os.path.expanduser(args.dbname)}.lock', args.lock_wait)
+    try:
+        lock.acquire()
+    except runlock.LockedError as err:
+        mainlog.warning('%s; exiting', err)
+        sys.exit(f'dv_coll_linker: {err}')
+    try:
+        run(args, mainlog)
+    finally:
+        lock.release()
+
+def run(args:argparse.Namespace, mainlog:logging.Logger) -> metrics.Metrics:
+    '''
+    Runs the application with the run lock held. Returns the metrics of
+    a single update check, or None for --verify and --daemonize.
+    '''
+    state = LinkerState(args)
+    if args.profile or args.profile_memory:
+        from dv_coll_linker import profiling
+        state.profiler = profiling.Profiler(args.log, memory=args.profile_memory)
+        state.profiler.start()
+    try:
+        if args.verify:
+            run_verify(state)
+        elif args.daemonize:
+            daemon(state, args.interval)
         else:
-            allrecs = monitor.get_search_data(conn)
-
-        monitor.purge_nonexistent(conn, allrecs)
-
-        #And now the magic happens
-        for branch in family_tree:
-            #Checking by time example
-            #new = [x for x in allrecs['data']['items'] if
-            #      datetime.datetime.strptime(x['updatedAt'], TIMEFMT) >
-            #      datetime.datetime.strptime(date, TIMEFMT) and
-            #      x['identifier_of_dataverse'] == branch[1]]
-            #However . . .
-            #Checking by time doesn't work if collections are deleted
-            #Link must not currently exist
-            #new = [x for x in allrecs['data']['items'] if
-            #       x['identifier_of_dataverse'] == branch[1]
-            #       and not monitor.check_link(conn, x['global_id'])]
-
-            #for item in new:
-            for item in [x for x in allrecs['data']['items'] if
-                         x['identifier_of_dataverse'] == branch[1]
-                         and not monitor.check_link(conn, x['global_id'],
-                                                    branch[0], branch[1])]:
-
-                mainlog.debug('%s\t%s\t%s\t%s',
-                             item['global_id'], branch[0],
-                             branch[1], item['identifier_of_dataverse'])
-                mainlog.info('Creating link %s to %s', item["global_id"], branch[0])
-                if linker.create_link(item['global_id'], branch[0], args.url, args.key):
-                    monitor.add_link(conn, item['global_id'], branch[0], branch[1])
-
-        #Unlink and remove old links from deleted collections
-        for gone in monitor.check_unlink(conn):
-            #mainlog.info('Removing link for %s', gone)
-            if linker.unlink(gone[0], gone[1], args.url, args.key):
-                mainlog.info('Removed link for %s', gone)
-                monitor.remove_link(conn, *gone)
-                mainlog.info('Removed %s from links table', gone[0])
-        conn.commit()
-        conn.close()
+            return run_cycle(state)
     except Exception as err:
         mainlog.exception(err)
         mainlog.exception(traceback.format_exc())
         raise
+    finally:
+        if state.profiler is not None:
+            state.profiler.stop()
+        state.close()
+    return None
 
 if __name__ == '__main__':
     main()
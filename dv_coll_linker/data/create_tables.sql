@@ -36,3 +36,7 @@ CREATE TABLE IF NOT EXISTS raw_data
 ( last_check TEXT,
 search_json TEXT,
 FOREIGN KEY (last_check) REFERENCES status(last_check));
+
+CREATE TABLE IF NOT EXISTS schema_version
+( version INTEGER PRIMARY KEY,
+applied TEXT);
@@ -0,0 +1,20 @@
+DELETE FROM links WHERE rowid NOT IN
+(SELECT MIN(rowid) FROM links GROUP BY pid, parent, child);
+
+CREATE UNIQUE INDEX IF NOT EXISTS links_pid_parent_child
+ON links (pid, parent, child);
+
+CREATE INDEX IF NOT EXISTS links_parent_child
+ON links (parent, child);
+
+CREATE INDEX IF NOT EXISTS studies_dv_alias
+ON studies (dv_alias);
+
+CREATE INDEX IF NOT EXISTS children_parent_child
+ON children (parent_alias, child_alias);
+
+CREATE INDEX IF NOT EXISTS children_child
+ON children (child_alias);
+
+CREATE INDEX IF NOT EXISTS raw_data_last_check
+ON raw_data (last_check);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS run_metrics
+( run_start TEXT,
+metric TEXT,
+labels TEXT,
+value REAL);
+
+CREATE INDEX IF NOT EXISTS run_metrics_run_start
+ON run_metrics (run_start);
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS collection_tree
+( alias TEXT PRIMARY KEY,
+owner TEXT);
+
+CREATE TABLE IF NOT EXISTS collection_closure
+( ancestor TEXT,
+descendant TEXT,
+depth INTEGER,
+PRIMARY KEY (ancestor, descendant)) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS collection_closure_descendant
+ON collection_closure (descendant);
@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS op_journal
+( id INTEGER PRIMARY KEY,
+op TEXT,
+pid TEXT,
+parent TEXT,
+child TEXT,
+planned TEXT,
+done TEXT,
+result TEXT);
+
+CREATE INDEX IF NOT EXISTS op_journal_pending
+ON op_journal (op, pid, parent, child) WHERE done IS NULL;
+
+CREATE INDEX IF NOT EXISTS op_journal_done
+ON op_journal (done);
@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS harvested_scopes
+( alias TEXT PRIMARY KEY,
+harvested TEXT);
+
+INSERT OR IGNORE INTO harvested_scopes (alias)
+SELECT DISTINCT child_alias FROM children WHERE child_alias IN
+(SELECT dv_alias FROM studies UNION
+ SELECT cc.ancestor FROM collection_closure AS cc
+ INNER JOIN studies AS s ON s.dv_alias = cc.descendant);
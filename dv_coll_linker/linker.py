@@ -4,12 +4,17 @@ Implementation of Dataverse study linking as Python functions.
 Nothing fancy, but it does add log messages on failures.
 '''
 
+import concurrent.futures
 import logging
+import threading
 import requests
 
+from dv_coll_linker.session import CircuitOpenError, get_session
+
 LOGGER = logging.getLogger(__name__)
 
-def create_link(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
+def create_link(pid:str, parent:str, url:str, key:str, timeout:int=100,
+                session:requests.Session=None) -> bool:
     '''
     Create a dataverse link of pid to collection parent.
     Returns true on successful (new) link.
@@ -24,12 +29,17 @@ def create_link(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
         API key for Dataverse installation. Note: linking requires superuser privileges.
     timeout: int
         Timeout in seconds
+    session: requests.Session
+        Session to use for the request. Defaults to the shared session
+        from dv_coll_linker.session
     '''
+    if session is None:
+        session = get_session()
     try:
-        linky = requests.put(f'{url}/api/datasets/:persistentId/link/{parent}',
-                             headers={'X-Dataverse-key': key},
-                             params={'persistentId':pid},
-                             timeout=timeout)
+        linky = session.put(f'{url}/api/datasets/:persistentId/link/{parent}',
+                            headers={'X-Dataverse-key': key},
+                            params={'persistentId':pid},
+                            timeout=timeout)
         if linky.json().get('status') == 'ERROR':
             if linky.json().get('message') == ('Can\'t link a dataset that has '
                                                'already been linked to this dataverse'):
@@ -44,7 +54,8 @@ def create_link(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
     LOGGER.info('%s linked to %s', pid, parent)
     return True
 
-def unlink(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
+def unlink(pid:str, parent:str, url:str, key:str, timeout:int=100,
+           session:requests.Session=None) -> bool:
     '''
     Removes a Dataverse link of pid to collection parent.
     Returns true on successful removal.
@@ -58,12 +69,17 @@ def unlink(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
         API key for Dataverse installation. Note: linking requires superuser privileges.
     timeout: int
         Timeout in seconds
+    session: requests.Session
+        Session to use for the request. Defaults to the shared session
+        from dv_coll_linker.session
     '''
+    if session is None:
+        session = get_session()
     try:
-        unlinky = requests.delete(f'{url}/api/datasets/:persistentId/deleteLink/{parent}',
-                                  headers={'X-Dataverse-key': key},
-                                  params={'persistentId':pid},
-                                  timeout=timeout)
+        unlinky = session.delete(f'{url}/api/datasets/:persistentId/deleteLink/{parent}',
+                                 headers={'X-Dataverse-key': key},
+                                 params={'persistentId':pid},
+                                 timeout=timeout)
         if unlinky.json().get('status') == 'ERROR':
             if (unlinky.json().get('message').startswith('Dataset linking') and
                 unlinky.json().get('message').endswith('not found.')):
@@ -80,3 +96,148 @@ def unlink(pid:str, parent:str, url:str, key:str, timeout:int=100) -> bool:
         return False
     LOGGER.info('%s unlinked from %s', pid, parent)
     return True
+
+def get_links(pid:str, url:str, key:str, timeout:int=100,
+              session:requests.Session=None) -> set:
+    '''
+    Returns the aliases of the collections which pid is linked to, or
+    None if they can't be found.
+
+    pid: str
+        Dataverse persistent ID (handle or DOI)
+    url: str
+        Base url to Dataverse installation
+    key: str
+        API key for Dataverse installation. Note: requires superuser privileges.
+    timeout: int
+        Timeout in seconds
+    session: requests.Session
+        Session to use for the request. Defaults to the shared session
+        from dv_coll_linker.session
+    '''
+    if session is None:
+        session = get_session()
+    try:
+        linky = session.get(f'{url}/api/datasets/:persistentId/links',
+                            headers={'X-Dataverse-key': key},
+                            params={'persistentId':pid},
+                            timeout=timeout)
+        if linky.json().get('status') == 'ERROR':
+            LOGGER.warning('%s: %s', pid, linky.json().get('message'))
+            return None
+        linky.raise_for_status()
+        data = linky.json().get('data', {})
+    except (requests.exceptions.HTTPError, requests.exceptions.JSONDecodeError):
+        LOGGER.exception('Requests Error')
+        return None
+    aliases = set()
+    #Older versions list 'alias (id 123)' strings under a descriptive key,
+    #newer ones {'id':..., 'alias':..., 'displayName':...} objects
+    for value in data.values():
+        if not isinstance(value, list):
+            continue
+        for linked in value:
+            if isinstance(linked, dict):
+                aliases.add(linked.get('alias'))
+            else:
+                aliases.add(str(linked).rsplit(' (id ', 1)[0])
+    aliases.discard(None)
+    return aliases
+
+def batch_get_links(pids:list, url:str, key:str, workers:int=4, timeout:int=100,
+                    session:requests.Session=None) -> dict:
+    '''
+    Finds the links of many PIDs concurrently. Returns a dict of
+    pid -> set of collection aliases (or None on failure), as per get_links.
+
+    Arguments are as per batch_link, with pids a list of persistent IDs.
+    '''
+    if session is None:
+        session = get_session()
+    def run(pid):
+        try:
+            return get_links(pid, url, key, timeout, session)
+        except requests.exceptions.RequestException:
+            LOGGER.exception('Request failed for %s', pid)
+            return None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(pids, pool.map(run, pids)))
+
+def _batch(func, ops:list, url:str, key:str, workers:int,
+           timeout:int, session:requests.Session, callback=None) -> list:
+    '''
+    Runs func(pid, parent, ...) for each operation with at most
+    {workers} requests in flight, returning (op, result) in order.
+    If supplied, callback(op, result) is called in the calling thread
+    as results arrive.
+
+    Once the session's circuit breaker opens, the rest of the batch is
+    abandoned: those operations have a result of None and callback
+    isn't called for them.
+    '''
+    if session is None:
+        session = get_session()
+    stopped = threading.Event()
+    def run(op):
+        if stopped.is_set():
+            return None
+        try:
+            return func(op[0], op[1], url, key, timeout, session)
+        except CircuitOpenError as err:
+            if not stopped.is_set():
+                stopped.set()
+                LOGGER.error('%s; abandoning the remaining operations', err)
+            return None
+        except requests.exceptions.RequestException:
+            #eg, connection errors; one failure shouldn't stop the batch
+            LOGGER.exception('Request failed for %s, %s', op[0], op[1])
+            return False
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for op, result in zip(ops, pool.map(run, ops)):
+            if callback is not None and result is not None:
+                callback(op, result)
+            results.append((op, result))
+    return results
+
+def batch_link(ops:list, url:str, key:str, workers:int=4, timeout:int=100,
+               session:requests.Session=None, callback=None) -> list:
+    '''
+    Creates many links concurrently. Returns a list of (op, result)
+    tuples in the same order as ops, where result is as per create_link;
+    that is, True for new or already existing links. Operations not
+    attempted because the circuit breaker opened have a result of None.
+
+    ops: list
+        (pid, parent) tuples. Any further elements, such as the child
+        collection from planner.LinkPlan, are ignored but returned
+        with the result.
+    url: str
+        Base url to Dataverse installation
+    key: str
+        Superuser API key for Dataverse installation.
+    workers: int
+        Maximum number of concurrent requests
+    timeout: int
+        Timeout in seconds
+    session: requests.Session
+        Session shared by all requests. Its connection pool should be
+        at least {workers} in size.
+    callback: callable
+        Called with (op, result) for each operation as it completes, in
+        the calling thread, eg, to record progress. Not called for
+        operations which weren't attempted.
+    '''
+    return _batch(create_link, ops, url, key, workers, timeout, session, callback)
+
+def batch_unlink(ops:list, url:str, key:str, workers:int=4, timeout:int=100,
+                 session:requests.Session=None, callback=None) -> list:
+    '''
+    Removes many links concurrently. Returns a list of (op, result)
+    tuples in the same order as ops, where result is as per unlink;
+    that is, True for removed or already missing links, or None if not
+    attempted.
+
+    Arguments are as per batch_link.
+    '''
+    return _batch(unlink, ops, url, key, workers, timeout, session, callback)
@@ -0,0 +1,217 @@
+'''
+Run metrics: per-phase timers, counters and HTTP latency histograms.
+
+A Metrics object collects measurements for a single update check. At the
+end of the check they can be written to a Prometheus node exporter
+textfile (see to_prometheus and write_textfile) and to the run_metrics
+table of the link database (see rows and monitor.write_run_metrics), so
+that slow or failing runs can be alerted on.
+'''
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+LOGGER = logging.getLogger(__name__)
+
+PREFIX = 'dv_coll_linker'
+#Upper bounds, in seconds, of the HTTP latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def endpoint(url:str) -> str:
+    '''
+    Returns a short name for the Dataverse API endpoint of {url}, for
+    use as a metric label: search, link, unlink or other
+    '''
+    path = urllib.parse.urlparse(url).path
+    if path.endswith('/api/search'):
+        return 'search'
+    if '/deleteLink/' in path:
+        return 'unlink'
+    if '/link/' in path:
+        return 'link'
+    return 'other'
+
+class Histogram:
+    '''
+    Cumulative histogram of observations, as used by Prometheus
+    '''
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value:float) -> None:
+        '''
+        Adds an observation
+        '''
+        for num, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[num] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    '''
+    Thread safe collection of the measurements for one update check.
+
+    phases : dict
+        Phase name -> seconds spent in that phase
+    counters : dict
+        Counter name -> value
+    latency : dict
+        HTTP endpoint name -> Histogram of request durations in seconds
+    hook : callable
+        If set, called with a label such as 'ingest start' or 'ingest end'
+        at each phase boundary, eg, profiling.Profiler.mark
+    '''
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.latency = {}
+        self.success = None
+        self.hook = None
+        self.lock = threading.Lock()
+
+    def add_time(self, name:str, seconds:float) -> None:
+        '''
+        Adds {seconds} to phase {name}
+        '''
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name:str):
+        '''
+        Context manager timing a phase. Time spent in a phase which is
+        entered more than once is added up.
+        '''
+        if self.hook:
+            self.hook(f'{name} start')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            if self.hook:
+                self.hook(f'{name} end')
+
+    def inc(self, name:str, value:int=1) -> None:
+        '''
+        Adds {value} to counter {name}
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name:str, seconds:float) -> None:
+        '''
+        Records the duration of a request to HTTP endpoint {name}
+        '''
+        with self.lock:
+            if name not in self.latency:
+                self.latency[name] = Histogram()
+            self.latency[name].observe(seconds)
+
+    def iter_pages(self, pages, phase:str='search', exclude:str=None):
+        '''
+        Passes on each page from the iterable {pages}, counting pages and
+        records and adding the time spent waiting for them to {phase}.
+
+        exclude : str
+            Phase being timed while the pages are consumed. The time spent
+            waiting for pages is deducted from it, so the two don't overlap.
+        '''
+        pages = iter(pages)
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            finally:
+                wait = time.perf_counter() - start
+                self.add_time(phase, wait)
+                if exclude:
+                    self.add_time(exclude, -wait)
+            self.inc('pages_fetched')
+            self.inc('records_fetched', len(page))
+            yield page
+
+    def rows(self) -> list:
+        '''
+        Returns (metric, labels, value) tuples for every measurement, where
+        labels is a string of comma separated name=value pairs
+        '''
+        with self.lock:
+            out = [('phase_seconds', f'phase={name}', value)
+                   for name, value in sorted(self.phases.items())]
+            out += [(name, '', value) for name, value in sorted(self.counters.items())]
+            for name, hist in sorted(self.latency.items()):
+                out += [('http_request_duration_seconds_bucket',
+                         f'endpoint={name},le={bound}', count)
+                        for bound, count in zip(hist.buckets, hist.counts)]
+                out += [('http_request_duration_seconds_count', f'endpoint={name}', hist.count),
+                        ('http_request_duration_seconds_sum', f'endpoint={name}', hist.total)]
+        out.append(('run_seconds', '', time.time() - self.started))
+        if self.success is not None:
+            out.append(('run_success', '', int(self.success)))
+        return out
+
+    def to_prometheus(self) -> str:
+        '''
+        Returns the measurements in the Prometheus text exposition format
+        '''
+        lines = [f'# HELP {PREFIX}_last_run_timestamp_seconds Start time of the last run',
+                 f'# TYPE {PREFIX}_last_run_timestamp_seconds gauge',
+                 f'{PREFIX}_last_run_timestamp_seconds {self.started:.3f}',
+                 f'# HELP {PREFIX}_run_seconds Duration of the last run',
+                 f'# TYPE {PREFIX}_run_seconds gauge',
+                 f'{PREFIX}_run_seconds {time.time() - self.started:.3f}']
+        with self.lock:
+            if self.success is not None:
+                lines += [f'# HELP {PREFIX}_run_success 1 if the last run succeeded',
+                          f'# TYPE {PREFIX}_run_success gauge',
+                          f'{PREFIX}_run_success {int(self.success)}']
+            lines += [f'# HELP {PREFIX}_phase_seconds Time spent in each phase of the last run',
+                      f'# TYPE {PREFIX}_phase_seconds gauge']
+            lines += [f'{PREFIX}_phase_seconds{{phase="{name}"}} {value:.6f}'
+                      for name, value in sorted(self.phases.items())]
+            for name, value in sorted(self.counters.items()):
+                lines += [f'# TYPE {PREFIX}_{name} gauge',
+                          f'{PREFIX}_{name} {value}']
+            if self.latency:
+                lines += [f'# HELP {PREFIX}_http_request_duration_seconds '
+                          'Dataverse API request durations in the last run',
+                          f'# TYPE {PREFIX}_http_request_duration_seconds histogram']
+            for name, hist in sorted(self.latency.items()):
+                metric = f'{PREFIX}_http_request_duration_seconds'
+                lines += [f'{metric}_bucket{{endpoint="{name}",le="{bound}"}} {count}'
+                          for bound, count in zip(hist.buckets, hist.counts)]
+                lines += [f'{metric}_bucket{{endpoint="{name}",le="+Inf"}} {hist.count}',
+                          f'{metric}_sum{{endpoint="{name}"}} {hist.total:.6f}',
+                          f'{metric}_count{{endpoint="{name}"}} {hist.count}']
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path:str) -> None:
+        '''
+        Writes the measurements to {path} for the node exporter textfile
+        collector. The file is replaced atomically, so the collector never
+        reads a partial file.
+        '''
+        path = os.path.expanduser(path)
+        fdesc, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                          prefix='.dv_coll_linker', suffix='.tmp')
+        try:
+            with os.fdopen(fdesc, 'w', encoding='utf-8') as out:
+                out.write(self.to_prometheus())
+            os.chmod(tmpname, 0o644)
+            os.replace(tmpname, path)
+        except OSError:
+            os.remove(tmpname)
+            raise
+        LOGGER.debug('Wrote metrics to %s', path)
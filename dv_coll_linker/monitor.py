@@ -12,73 +12,206 @@ This module basically acts as a singleton object on import.
 '''
 import json
 import logging
+import os
 import sqlite3
 import traceback
-#import sys
-import pkg_resources
+import zlib
+
+from dv_coll_linker.records import Study
 
 LOGGER = logging.getLogger(__name__)
 
-#if sys.version_info[1] >= 7:
-#    import importlib.resources as ilib
-#    try:
-#        from . import data
-#    except ImportError:
-#        import data
-#else:
-#    LOGGER.warning('Using Python 3.6 or below')
-#    #import importlib_resources as ilib
-#    import pkg_resources
-
-try:
-    import psycopg2
-    NOPG = False
-except (ModuleNotFoundError, ImportError):
-    NOPG = True
+#Records per batched statement; SQLite limits the variables in a query
+BATCHSIZE = 500
+
+#Link database connection tuning. WAL journaling lets other processes
+#read the database during a run; NORMAL synchronous is durable in WAL
+#mode except for the last transactions before a power failure.
+SYNCHRONOUS = 'NORMAL'
+#Seconds to wait for another connection's write lock
+BUSY_TIMEOUT = 30
+#Page cache size; negative values are in kB
+CACHE_SIZE = -20000
+
+#SQL files shipped with the package. Found relative to this module
+#rather than with pkg_resources, which is slow to import.
+DATADIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+#Search API record keys used to populate the studies table
+STUDY_KEYS = Study._fields
+
+#Published datasets, with the title of the latest published version,
+#formatted like the search API results
+PG_STUDIES = ('''SELECT dvo.protocol || ':' || dvo.authority || '/' || dvo.identifier,
+owner.alias,
+title.value,
+to_char(dvo.createdate, 'YYYY-MM-DD"T"HH24:MI:SS"Z"'),
+to_char(dv.lastupdatetime, 'YYYY-MM-DD"T"HH24:MI:SS"Z"')
+FROM dvobject AS dvo
+INNER JOIN dataverse AS owner ON owner.id = dvo.owner_id
+INNER JOIN LATERAL
+(SELECT id, lastupdatetime FROM datasetversion
+ WHERE dataset_id = dvo.id AND versionstate = 'RELEASED'
+ ORDER BY versionnumber DESC, minorversionnumber DESC LIMIT 1) AS dv ON TRUE
+LEFT JOIN LATERAL
+(SELECT dfv.value FROM datasetfield AS df
+ INNER JOIN datasetfieldtype AS dft ON dft.id = df.datasetfieldtype_id
+ INNER JOIN datasetfieldvalue AS dfv ON dfv.datasetfield_id = df.id
+ WHERE df.datasetversion_id = dv.id AND dft.name = 'title' LIMIT 1) AS title ON TRUE
+WHERE dvo.dtype = 'Dataset'
+ORDER BY dvo.id;''')
+
+#Every collection with the alias of the collection which owns it
+PG_TREE = ('SELECT dv.alias, owner.alias FROM dataverse AS dv '
+           'INNER JOIN dvobject AS dvo ON dvo.id = dv.id '
+           'LEFT JOIN dataverse AS owner ON owner.id = dvo.owner_id;')
+
+#Removes the paths from a collection's sub-tree to the collection's ancestors
+CLOSURE_DETACH = ('DELETE FROM collection_closure WHERE descendant IN '
+                  '(SELECT descendant FROM collection_closure WHERE ancestor = ?) '
+                  'AND ancestor NOT IN '
+                  '(SELECT descendant FROM collection_closure WHERE ancestor = ?);')
+#Adds paths from a new owner and its ancestors to a collection's sub-tree
+CLOSURE_ATTACH = ('INSERT OR IGNORE INTO collection_closure '
+                  'SELECT sup.ancestor, sub.descendant, sup.depth + sub.depth + 1 '
+                  'FROM collection_closure AS sup, collection_closure AS sub '
+                  'WHERE sup.descendant = ? AND sub.ancestor = ?;')
+
+def connect(dbname:str, synchronous:str=SYNCHRONOUS, busy_timeout:float=BUSY_TIMEOUT,
+            cache_size:int=CACHE_SIZE) -> sqlite3.Connection:
+    '''
+    Returns a connection to the link database {dbname}, in WAL mode with
+    foreign keys enforced.
+
+    synchronous : str
+        SQLite synchronous level: OFF, NORMAL, FULL or EXTRA
+    busy_timeout : float
+        Seconds to wait for a lock held by another connection
+    cache_size : int
+        SQLite page cache size, in pages, or in kB if negative
+    '''
+    if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f'Invalid synchronous level {synchronous}')
+    conn = sqlite3.connect(dbname, timeout=busy_timeout)
+    cursor = conn.cursor()
+    mode = cursor.execute('PRAGMA journal_mode=WAL;').fetchone()[0]
+    if mode.lower() != 'wal':
+        #eg, in-memory databases
+        LOGGER.debug('Journal mode is %s', mode)
+    cursor.execute(f'PRAGMA synchronous={synchronous};')
+    cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)};')
+    cursor.execute(f'PRAGMA cache_size={int(cache_size)};')
+    cursor.execute('PRAGMA foreign_keys=ON;')
+    return conn
 
 def init(dbname:str) -> sqlite3.Connection:
     '''Intialize database with {dbname}.'''
     #sqlite3.IntegrityError
-
-    #if sys.version_info[1] >= 7:
-    #    create = ilib.read_text(data, 'create_tables.sql').split('\n\n')
-    #    #create = [x.replace('\n', ' ') for x in create]
-    #else:
-    #    #pkg_resources.resource_filename('dv_coll_linker', 'data/create_tables.sql')
-    #    with open(pkg_resources.resource_filename('dv_coll_linker',
-    #                                              'data/create_tables.sql'),
-    #            'r', encoding='utf-8') as fil:
-    #        create = fil.read().split('\n\n')
-    with open(pkg_resources.resource_filename('dv_coll_linker',
-                                              'data/create_tables.sql'),
-            'r', encoding='utf-8') as fil:
+    with open(os.path.join(DATADIR, 'create_tables.sql'), 'r', encoding='utf-8') as fil:
         create = fil.read().split('\n\n')
         LOGGER.info('Read database initialization SQL')
         LOGGER.info('%s', create)
-    conn = sqlite3.Connection(dbname)
+    conn = connect(dbname)
     cursor = conn.cursor()
-    cursor.execute('PRAGMA foreign_keys=ON;')
     for table in create:
         cursor.execute(table)
         conn.commit()
+    migrate(conn)
     LOGGER.info('Initialized database')
     return conn
 
+def schema_version(conn:sqlite3.Connection) -> int:
+    '''
+    Returns the schema version of the database; 0 is the original schema
+    '''
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(version) FROM schema_version;')
+    return cursor.fetchone()[0] or 0
+
+def migrate(conn:sqlite3.Connection) -> int:
+    '''
+    Upgrades an existing database in place by applying, in order, each
+    migration in data/migrations newer than the current schema version.
+    Each migration is applied in its own transaction. Returns the
+    resulting schema version.
+    '''
+    version = schema_version(conn)
+    migrations = sorted(x for x in os.listdir(os.path.join(DATADIR, 'migrations'))
+                        if x.endswith('.sql'))
+    cursor = conn.cursor()
+    for fname in migrations:
+        num = int(fname.split('_')[0])
+        if num <= version:
+            continue
+        with open(os.path.join(DATADIR, 'migrations', fname), 'r', encoding='utf-8') as fil:
+            statements = fil.read().split('\n\n')
+        LOGGER.info('Applying database migration %s', fname)
+        try:
+            cursor.execute('BEGIN;')
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_version VALUES (?, datetime(\'now\'));',
+                           (num,))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            LOGGER.exception('Migration %s failed', fname)
+            raise
+        version = num
+    return version
+
+def _psycopg2():
+    '''
+    Returns the psycopg2 module, or None if it isn't installed. It is
+    only imported once a PostgreSQL connection is needed, so that runs
+    without one don't pay for it.
+    '''
+    try:
+        import psycopg2 #pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return psycopg2
+
+def pg_connect(dbname:str, user:str, password:str,
+               host:str='localhost', port:int=5432):
+    '''
+    Returns a psycopg2 connection to the Dataverse PostgreSQL database,
+    or None if a connection can't be made.
+    '''
+    psycopg2 = _psycopg2()
+    if psycopg2 is None:
+        LOGGER.warning('Did not connect to PostgreSQL database; no psycopg2')
+        return None
+    try:
+        return psycopg2.connect(dbname=dbname, user=user,
+                                password=password,
+                                host=host, port=port)
+    except psycopg2.OperationalError:
+        LOGGER.exception('Postgres Error')
+        LOGGER.critical(('Params – dbname: %s, user: %s, password: %s, '
+                         'host:%s, port: %s'), dbname, user, '[redacted]',
+                         host, port)
+        return None
+
 def get_pg_data(dbname:str, user:str, password:str,
-                host:str='localhost', port:int=5432) -> (list, list):
+                host:str='localhost', port:int=5432, pconn=None) -> (list, list):
     '''
     Grabs linking data from postgres database. Returns two lists used
     to populate the collections and children tables
+
+    If an open connection from pg_connect is supplied as pconn, it is used
+    and left open; otherwise a new connection is made and closed.
     '''
     #pconn=psycopg2.connect(dbname='dvndb', user='dvnapp', password='')
-    if NOPG:
-        LOGGER.warning('Did not connect to PostgreSQL database; no psycopg2')
+    close = pconn is None
+    if close:
+        pconn = pg_connect(dbname, user, password, host, port)
+    if pconn is None:
         return None, None
+    psycopg2 = _psycopg2()
+    pg_errors = psycopg2.OperationalError if psycopg2 is not None else ()
 
     try:
-        pconn=psycopg2.connect(dbname=dbname, user=user,
-                               password=password,
-                               host=host, port=port)
         pcursor = pconn.cursor()
         pcursor.execute('SELECT id, alias, name FROM dataverse;')
         collections = pcursor.fetchall()
@@ -90,49 +223,186 @@ def get_pg_data(dbname:str, user:str, password:str,
                          'INNER JOIN dataverse AS parent '
                          'ON parent.id = dl.linkingdataverse_id ORDER BY parent_id;'))
         children = pcursor.fetchall()
-        pconn.close()
+        #Don't leave a long lived connection idle in a transaction
+        pconn.rollback()
         LOGGER.info('Successfully parsed PostgreSQL database')
         return collections, children
 
-    except psycopg2.OperationalError:
+    except pg_errors:
         LOGGER.exception('Postgres Error')
         LOGGER.critical(('Params – dbname: %s, user: %s, password: %s, '
                          'host:%s, port: %s'), dbname, user, '[redacted]',
                          host, port)
         return None, None
+    finally:
+        if close:
+            pconn.close()
+
+def get_pg_tree(pconn) -> list:
+    '''
+    Returns (alias, owner alias) pairs for every collection in the
+    Dataverse PostgreSQL database, from dvobject.owner_id. The owner of
+    the root collection is None. Returns None if the query fails.
+
+    pconn : psycopg2 connection
+        Open connection, as from pg_connect
+    '''
+    psycopg2 = _psycopg2()
+    pg_errors = psycopg2.OperationalError if psycopg2 is not None else ()
+    try:
+        pcursor = pconn.cursor()
+        pcursor.execute(PG_TREE)
+        tree = pcursor.fetchall()
+        pconn.rollback()
+        return tree
+    except pg_errors:
+        LOGGER.exception('Postgres Error')
+        return None
+
+def iter_pg_pages(pconn, since:str=None, per_page:int=1000):
+    '''
+    Generator yielding lists of published dataset records read directly from
+    the Dataverse PostgreSQL database, as records.Study tuples.
+
+    Rows are streamed through a named server side cursor, so only
+    {per_page} rows are held in memory at a time.
+
+    pconn : psycopg2 connection
+        As from pg_connect
+    since : str
+        If supplied, only datasets whose latest published version was
+        updated at or after this time are returned. This includes new
+        minor versions, but not moves between collections, which don't
+        change the version.
+    per_page : int
+        Number of rows fetched from the server at once
+    '''
+    query = PG_STUDIES
+    params = {}
+    if since:
+        query = query.replace('WHERE dvo.dtype', 'WHERE dv.lastupdatetime >= %(since)s '
+                                                 'AND dvo.dtype')
+        params['since'] = since
+    try:
+        pcursor = pconn.cursor(name='dv_coll_linker_studies')
+        pcursor.itersize = per_page
+        pcursor.execute(query, params)
+        while True:
+            rows = pcursor.fetchmany(per_page)
+            if not rows:
+                break
+            yield [Study(*row) for row in rows]
+        pcursor.close()
+    finally:
+        #Named cursors live in a transaction, which shouldn't be left open
+        pconn.rollback()
+
+def _diff_rows(old:list, new:list, key) -> tuple:
+    '''
+    Compares two lists of rows using key(row) as the identity of a row.
+    Returns lists of rows to insert, rows to update and rows to delete.
+    '''
+    old = {key(x): tuple(x) for x in old}
+    new = {key(x): tuple(x) for x in new}
+    inserts = [v for k, v in new.items() if k not in old]
+    updates = [v for k, v in new.items() if k in old and old[k] != v]
+    deletes = [v for k, v in old.items() if k not in new]
+    return inserts, updates, deletes
 
 def populate_db(conn:sqlite3.Connection,
-                collections:list, children:list)-> bool:
+                collections:list, children:list)-> dict:
     '''
     Updates the database with linking dataverse info
+
+    Only rows which differ from the current collections and children
+    tables are written, in a single transaction. Returns the number of rows
+    inserted, updated and deleted for each table, eg
+    {'collections': {'inserted': 1, 'updated': 0, 'deleted': 0}, ...}
     '''
     cursor = conn.cursor()
-    orig_coll = set(cursor.execute('SELECT * FROM collections;').fetchall())
-    orig_children = set(cursor.execute('SELECT * FROM children').fetchall())
-    for rec in collections:
-        try:
-            cursor.execute('INSERT INTO collections VALUES (?, ?, ?)', rec)
-        except sqlite3.IntegrityError:
-            cursor.execute(('UPDATE collections SET id=?, alias=? , name=? '
-                                'WHERE alias = ?'), list(rec) +[rec[1]])
-        conn.commit()
-    for rec in children:
-        try:
-            cursor.execute('INSERT INTO children VALUES (?, ?, ?, ?)', rec)
-        except sqlite3.IntegrityError:
-            cursor.execute(('UPDATE children SET '
+    coll = _diff_rows(cursor.execute('SELECT id, alias, name FROM collections;').fetchall(),
+                      collections, lambda x: x[1])
+    kids = _diff_rows(cursor.execute(('SELECT parent_id, parent_alias, child_id, child_alias '
+                                      'FROM children;')).fetchall(),
+                      children, lambda x: (x[1], x[3]))
+    summary = {name: dict(zip(('inserted', 'updated', 'deleted'), map(len, diff)))
+               for name, diff in (('collections', coll), ('children', kids))}
+    if not any(any(x) for x in (coll, kids)):
+        LOGGER.debug('Collections and children unchanged')
+        return summary
+    try:
+        #children refer to collections, so remove them first and add them last
+        cursor.executemany(('DELETE FROM children WHERE parent_alias=? '
+                            'AND child_alias=?;'), [(x[1], x[3]) for x in kids[2]])
+        cursor.executemany('DELETE FROM collections WHERE alias=?;',
+                           [(x[1],) for x in coll[2]])
+        cursor.executemany('INSERT INTO collections VALUES (?, ?, ?);', coll[0])
+        cursor.executemany('UPDATE collections SET id=?, alias=?, name=? WHERE alias=?;',
+                           [x + (x[1],) for x in coll[1]])
+        cursor.executemany('INSERT INTO children VALUES (?, ?, ?, ?);', kids[0])
+        cursor.executemany(('UPDATE children SET '
                             'parent_id=?, parent_alias=?, '
                             'child_id=?, child_alias=? '
-                            'WHERE parent_alias=? AND child_alias=?'),
-                            list(rec) + [rec[1], rec[3]])
-        conn.commit()
-    #set theory
-    cursor.executemany(('DELETE FROM children WHERE parent_id=? AND parent_alias=?'
-                        'AND child_id=? AND child_alias=?;'),
-                        orig_children - {tuple(x) for x in children})
-    cursor.executemany(('DELETE from collections WHERE id=? AND alias=? '
-                        'AND name=?'), orig_coll-{tuple(x) for x in collections})
+                            'WHERE parent_alias=? AND child_alias=?;'),
+                           [x + (x[1], x[3]) for x in kids[1]])
+    except sqlite3.Error:
+        conn.rollback()
+        LOGGER.exception('Could not update collections and children')
+        raise
     conn.commit()
+    LOGGER.info('Collection changes: %s', summary)
+    return summary
+
+def sync_collection_tree(conn:sqlite3.Connection, tree:list) -> dict:
+    '''
+    Updates the collection_tree table and its closure table,
+    collection_closure, to match {tree}. Returns the number of
+    collections inserted, moved (updated) and deleted.
+
+    The closure table holds an (ancestor, descendant, depth) row for
+    every collection and each of the collections above it, including
+    itself at depth 0, so that everything below a collection can be
+    found with a single indexed lookup. Only the paths affected by added,
+    moved and deleted collections are changed.
+
+    tree : list
+        (alias, owner alias) pairs for every collection, as from
+        get_pg_tree. The owner of the root collection is None.
+    '''
+    cursor = conn.cursor()
+    old = dict(cursor.execute('SELECT alias, owner FROM collection_tree;').fetchall())
+    new = dict(tree)
+    added = [x for x in new if x not in old]
+    moved = [x for x in new if x in old and old[x] != new[x]]
+    deleted = [x for x in old if x not in new]
+    summary = {'inserted': len(added), 'updated': len(moved), 'deleted': len(deleted)}
+    if not (added or moved or deleted):
+        LOGGER.debug('Collection tree unchanged')
+        return summary
+    try:
+        cursor.executemany('INSERT OR IGNORE INTO collection_closure VALUES (?, ?, 0);',
+                           [(x, x) for x in added])
+        #Detach everything first; attaching in any order is then correct
+        for alias in moved + deleted:
+            cursor.execute(CLOSURE_DETACH, (alias, alias))
+        cursor.executemany(('DELETE FROM collection_closure '
+                            'WHERE ancestor = ? OR descendant = ?;'),
+                           [(x, x) for x in deleted])
+        for alias in added + moved:
+            if new[alias] is not None:
+                cursor.execute(CLOSURE_ATTACH, (new[alias], alias))
+        cursor.executemany('DELETE FROM collection_tree WHERE alias = ?;',
+                           [(x,) for x in deleted])
+        cursor.executemany('INSERT OR REPLACE INTO collection_tree VALUES (?, ?);',
+                           [(x, new[x]) for x in added + moved])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        LOGGER.exception('Unable to update collection tree')
+        raise
+    LOGGER.info('Collection tree: %s added, %s moved, %s deleted',
+                len(added), len(moved), len(deleted))
+    return summary
 
 def fetch_parent_child_collections(conn:sqlite3.Connection)->list:
     '''
@@ -142,50 +412,133 @@ def fetch_parent_child_collections(conn:sqlite3.Connection)->list:
     cursor.execute('SELECT parent_alias, child_alias FROM children;')
     return cursor.fetchall()
 
-def add_single_study(conn:sqlite3.Connection, **kwargs) -> None:
+def fetch_subtree_aliases(conn:sqlite3.Connection, aliases) -> set:
     '''
-    Writes metadata from a single study to the database. Supply the
-    JSON from the record as keyword arguments.
+    Returns {aliases} and the aliases of all of their sub-collections, at
+    any depth, as found in the collection_closure table
     '''
-    values = (kwargs.get('global_id'),
-              kwargs.get('identifier_of_dataverse'),
-              kwargs.get('name'),
-              kwargs.get('createdAt'),
-              kwargs.get('updatedAt'))
+    aliases = set(aliases)
     cursor = conn.cursor()
-    cursor.execute('SELECT pid, updated_time FROM studies WHERE pid =?;',
-                   (values[0],))
-    out = cursor.fetchone()
-    if out and out[1] == values[4]:#record exists
-        LOGGER.debug('Existing study record: %s', values[0])
-        return
-    if out and out[1] != values[4]:#record updated
-        LOGGER.debug('Updated study record: %s', values[0])
-        cursor.execute(('UPDATE studies SET pid=?, dv_alias=?, title=?, '
-                        'created_time=?, updated_time=? WHERE pid=?;'),
-                        list(values) + [values[0]])
-        conn.commit()
-        return
-    #new record
-    cursor.execute('INSERT INTO studies VALUES (?, ?, ?, ?, ?);',
-                   values)
+    for alias in list(aliases):
+        aliases.update(x[0] for x in
+                       cursor.execute('SELECT descendant FROM collection_closure '
+                                      'WHERE ancestor = ?;', (alias,)))
+    return aliases
+
+def _study_values(rec) -> tuple:
+    '''
+    Returns the studies table row for a single search API record or
+    records.Study
+    '''
+    return tuple(Study.from_record(rec))
+
+def _upsert_study_batch(cursor:sqlite3.Cursor, batch:dict, counts:dict) -> None:
+    '''
+    Inserts or updates one batch of studies table rows keyed by PID,
+    adding the results to counts.
+    '''
+    existing = {x[0]: x[1:] for x in
+                cursor.execute(('SELECT pid, dv_alias, updated_time FROM studies '
+                                f'WHERE pid IN ({",".join("?"*len(batch))});'),
+                               list(batch))}
+    inserts = [v for k, v in batch.items() if k not in existing]
+    #A record is only changed if it has been updated or moved
+    updates = [list(v) + [k] for k, v in batch.items() if k in existing and
+               existing[k] != (v[1], v[4])]
+    cursor.executemany('INSERT INTO studies VALUES (?, ?, ?, ?, ?);', inserts)
+    cursor.executemany(('UPDATE studies SET pid=?, dv_alias=?, title=?, '
+                        'created_time=?, updated_time=? WHERE pid=?;'), updates)
+    counts['inserted'] += len(inserts)
+    counts['updated'] += len(updates)
+    counts['unchanged'] += len(batch) - len(inserts) - len(updates)
+    LOGGER.debug('Study batch: %s inserted, %s updated', len(inserts), len(updates))
 
-    LOGGER.info('Added record to studies: %s', values)
+def add_studies(conn:sqlite3.Connection, recs, batch_size:int=BATCHSIZE) -> dict:
+    '''
+    Writes metadata from many studies to the database in a single
+    transaction. Returns a dict with the number of studies
+    'inserted', 'updated' and 'unchanged'.
+
+    recs : iterable
+        Search API records or records.Study tuples (eg, search.iter_recs
+        or allrecs['data']['items']). Consumed one batch at a time.
+    batch_size : int
+        Number of records per batched statement
+    '''
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    cursor = conn.cursor()
+    batch = {}
+    try:
+        for rec in recs:
+            values = _study_values(rec)
+            batch[values[0]] = values
+            if len(batch) >= batch_size:
+                _upsert_study_batch(cursor, batch, counts)
+                batch = {}
+        if batch:
+            _upsert_study_batch(cursor, batch, counts)
+    except Exception:
+        conn.rollback()
+        raise
     conn.commit()
-    LOGGER.debug('Committed transaction')
-    return
+    LOGGER.info('Studies inserted: %s, updated: %s, unchanged: %s',
+                counts['inserted'], counts['updated'], counts['unchanged'])
+    return counts
 
-def purge_nonexistent(conn:sqlite3.Connection, allrecs:dict) -> None:
+def add_single_study(conn:sqlite3.Connection, **kwargs) -> None:
     '''
-    Removes PIDS that don't appear in allrecs['data']['items']
+    Writes metadata from a single study to the database. Supply the
+    JSON from the record as keyword arguments.
+
+    For more than a handful of studies, use add_studies instead.
     '''
-    newpids = {x['global_id'] for x in allrecs['data']['items']}
+    add_studies(conn, [kwargs])
+
+def purge_nonexistent(conn:sqlite3.Connection, allrecs, aliases:set=None,
+                      orphans:list=None) -> int:
+    '''
+    Removes PIDS that don't appear in allrecs['data']['items']. Returns
+    the number of PIDs removed.
+
+    allrecs may also be any iterable of search API records or
+    records.Study tuples, such as search.iter_recs or iter_search_data,
+    in which case it is consumed one record at a time, or a set of PIDs.
+
+    If the records only cover part of the installation, supply the
+    harvested collection aliases as {aliases}. Only studies in those
+    collections, or in any collection of the records in allrecs, are
+    then removed. A study missing from such a partial harvest may only
+    have moved out of the harvested collections, leaving its Dataverse
+    links in place, so supply a list as {orphans} to have the
+    (pid, parent, child) links of the removed studies appended to it
+    for unlinking.
+    '''
+    if isinstance(allrecs, dict):
+        allrecs = allrecs['data']['items']
+    if aliases is not None:
+        aliases = set(aliases)
+    if isinstance(allrecs, (set, frozenset)):
+        newpids = allrecs
+    else:
+        newpids = set()
+        for rec in allrecs:
+            newpids.add(rec['global_id'])
+            if aliases is not None:
+                aliases.add(rec['identifier_of_dataverse'])
+    if not newpids:
+        #An empty harvest would otherwise wipe out every study
+        LOGGER.warning('No harvested records; not purging studies')
+        return 0
     cursor = conn.cursor()
     #oldpids = set(cursor.execute('SELECT DISTINCT pid FROM studies;').fetchall())
 
-    oldpids = {x[0] for x in cursor.execute('SELECT DISTINCT pid FROM studies;').fetchall()}
+    if aliases is None:
+        oldpids = {x[0] for x in cursor.execute('SELECT DISTINCT pid FROM studies;').fetchall()}
+    else:
+        oldpids = {x[0] for x in cursor.execute('SELECT pid, dv_alias FROM studies;')
+                   if x[1] in aliases}
     if not oldpids:
-        return
+        return 0
     #remove the difference of sets
     diff = oldpids - newpids
     if len(diff) == 1: #Otherwise executemany iterates over a string
@@ -198,6 +551,10 @@ def purge_nonexistent(conn:sqlite3.Connection, allrecs:dict) -> None:
     if diff:
         try:
             LOGGER.info('Purging %s old records', len(diff))
+            if orphans is not None:
+                for pid in diff:
+                    orphans += cursor.execute('SELECT pid, parent, child FROM links '
+                                              'WHERE pid=?;', pid).fetchall()
             cursor.executemany('DELETE FROM studies WHERE pid=?;', diff)
             LOGGER.info('Records purged from *studies*: %s', diff)
             cursor.executemany('DELETE FROM links WHERE pid=?;', diff)
@@ -209,6 +566,73 @@ def purge_nonexistent(conn:sqlite3.Connection, allrecs:dict) -> None:
             LOGGER.critical(diff)
             raise
     conn.commit()
+    return len(diff)
+
+def fetch_study_index(conn:sqlite3.Connection, recursive:bool=True) -> dict:
+    '''
+    Returns a dict of collection alias -> set of study PIDs for every
+    child collection in the children table
+
+    recursive : bool
+        Include studies in the sub-collections of each child collection,
+        at any depth, as found in the collection_closure table (see
+        sync_collection_tree)
+    '''
+    cursor = conn.cursor()
+    query = ('SELECT dv_alias, pid FROM studies WHERE dv_alias IN '
+             '(SELECT child_alias FROM children)')
+    if recursive:
+        query = ('SELECT ch.child_alias, s.pid FROM '
+                 '(SELECT DISTINCT child_alias FROM children) AS ch '
+                 'INNER JOIN collection_closure AS cc ON cc.ancestor = ch.child_alias '
+                 'INNER JOIN studies AS s ON s.dv_alias = cc.descendant '
+                 f'UNION {query}')
+    cursor.execute(f'{query};')
+    index = {}
+    for alias, pid in cursor:
+        index.setdefault(alias, set()).add(pid)
+    return index
+
+def fetch_harvested_scopes(conn:sqlite3.Connection) -> set:
+    '''
+    Returns the aliases of the collections whose studies, and those of
+    their sub-collections, have been harvested (see record_harvested_scopes)
+    '''
+    cursor = conn.cursor()
+    return {x[0] for x in cursor.execute('SELECT alias FROM harvested_scopes;')}
+
+def record_harvested_scopes(conn:sqlite3.Connection, aliases, commit:bool=True) -> None:
+    '''
+    Records that the studies in collections {aliases} and their
+    sub-collections have been harvested. A collection with no studies of
+    its own, or none at all, can't be recognized from the studies table.
+
+    Set commit to False to leave the write in the caller's transaction,
+    eg, so that it only takes effect if the harvest succeeds.
+    '''
+    cursor = conn.cursor()
+    cursor.executemany(('INSERT OR REPLACE INTO harvested_scopes VALUES '
+                        '(?, strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\'));'),
+                       [(x,) for x in aliases])
+    if commit:
+        conn.commit()
+
+def forget_harvested_scopes(conn:sqlite3.Connection, keep:set) -> None:
+    '''
+    Forgets the harvests of collections not in {keep}, eg, those which are
+    no longer linked, so that they are harvested again if linked again
+    '''
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM harvested_scopes WHERE alias=?;',
+                       [(x,) for x in fetch_harvested_scopes(conn) - set(keep)])
+    conn.commit()
+
+def fetch_links(conn:sqlite3.Connection) -> set:
+    '''
+    Returns all (pid, parent, child) links in the links table
+    '''
+    cursor = conn.cursor()
+    return set(cursor.execute('SELECT pid, parent, child FROM links;').fetchall())
 
 def check_link_old(conn:sqlite3.Connection, pid:str) -> bool:
     '''
@@ -236,10 +660,18 @@ def add_link(conn:sqlite3.Connection, pid:str, parent: str, child: str) -> None:
     desc
     '''
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO links VALUES(?, ?, ?);',
+    cursor.execute('INSERT OR IGNORE INTO links VALUES(?, ?, ?);',
                    (pid, parent, child))
     conn.commit()
 
+def add_links(conn:sqlite3.Connection, links) -> None:
+    '''
+    Adds many (pid, parent, child) links to the links table in one transaction
+    '''
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR IGNORE INTO links VALUES(?, ?, ?);', links)
+    conn.commit()
+
 def check_unlink(conn:sqlite3.Connection)-> tuple:
     '''
     Returns persistent IDs where a link exists but a parent/child relationship
@@ -269,14 +701,84 @@ def remove_link(conn:sqlite3.Connection, pid:str, parent: str, child: str) -> No
                    (pid, parent, child))
     conn.commit()
 
-def write_status(conn:sqlite3.Connection, last_check:str, last_count: int)->None:
+def remove_links(conn:sqlite3.Connection, links) -> None:
+    '''
+    Removes many (pid, parent, child) links from the links table in one transaction
+    '''
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM links WHERE pid=? AND parent=? AND child=?;',
+                       links)
+    conn.commit()
+
+def journal_ops(conn:sqlite3.Connection, op:str, links:list) -> None:
     '''
-    Writes timestamp and total file count to database
+    Records planned operations in the op_journal table as pending, so
+    that they can be resumed if the run is interrupted.
+
+    op : str
+        'link' or 'unlink'
+    links : list
+        (pid, parent, child) links to create or remove
+    '''
+    cursor = conn.cursor()
+    cursor.executemany(('INSERT INTO op_journal (op, pid, parent, child, planned) '
+                        'VALUES (?, ?, ?, ?, strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\'));'),
+                       [(op, *x) for x in links])
+    conn.commit()
+
+def pending_ops(conn:sqlite3.Connection, op:str) -> list:
+    '''
+    Returns the (pid, parent, child) links of journaled {op} operations
+    which haven't been completed, in the order they were planned
+    '''
+    cursor = conn.cursor()
+    cursor.execute(('SELECT pid, parent, child FROM op_journal WHERE op = ? '
+                    'AND done IS NULL GROUP BY pid, parent, child ORDER BY MIN(id);'),
+                   (op,))
+    return cursor.fetchall()
+
+def complete_ops(conn:sqlite3.Connection, op:str, results:list) -> None:
+    '''
+    Marks journaled operations as done and applies the successful ones
+    to the links table, in one transaction.
+
+    op : str
+        'link' or 'unlink'
+    results : list
+        ((pid, parent, child), succeeded) tuples
     '''
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO status VALUES (?, ?)', (last_check, last_count))
+    done = [link for link, ok in results if ok]
+    if op == 'link':
+        cursor.executemany('INSERT OR IGNORE INTO links VALUES(?, ?, ?);', done)
+    else:
+        cursor.executemany('DELETE FROM links WHERE pid=? AND parent=? AND child=?;', done)
+    cursor.executemany(('UPDATE op_journal SET done = '
+                        'strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\'), result = ? '
+                        'WHERE op = ? AND pid = ? AND parent = ? AND child = ? '
+                        'AND done IS NULL;'),
+                       [('ok' if ok else 'failed', op, *link) for link, ok in results])
     conn.commit()
 
+def write_status(conn:sqlite3.Connection, last_check:str, last_count: int,
+                 commit:bool=True)->None:
+    '''
+    Writes timestamp and total file count to database. Set commit to False
+    to leave the write in the caller's transaction, eg, so that the
+    status is only recorded if the harvest it describes succeeds.
+
+    Timestamps are to the second, so a second check in the same second
+    updates the count of the first rather than adding a row. The row is
+    updated in place, not replaced, as raw_data snapshots refer to it.
+    '''
+    cursor = conn.cursor()
+    cursor.execute('UPDATE status SET last_count = ? WHERE last_check = ?;',
+                   (last_count, last_check))
+    if not cursor.rowcount:
+        cursor.execute('INSERT INTO status VALUES (?, ?);', (last_check, last_count))
+    if commit:
+        conn.commit()
+
 def get_last_count(conn:sqlite3.Connection) -> (str, int):
     '''
     Returns the last count of studies in a Dataverse installation
@@ -288,25 +790,140 @@ def get_last_count(conn:sqlite3.Connection) -> (str, int):
         return None, 0
     return last_count
 
+def get_last_harvest(conn:sqlite3.Connection) -> str:
+    '''
+    Returns the time of the last full harvest (ie, the latest search
+    snapshot), or None if there has never been one
+    '''
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(last_check) FROM raw_data')
+    return cursor.fetchone()[0]
+
+def _decode_snapshot(value) -> dict:
+    '''
+    Decodes a raw_data search_json value, which is either JSON text or
+    (since snapshots are compressed) zlib compressed JSON
+    '''
+    if isinstance(value, bytes):
+        value = zlib.decompress(value).decode('utf-8')
+    return json.loads(value)
+
 def get_search_data(conn:sqlite3.Connection)->dict:
     '''
     Retrieves last harvested search results
     '''
     cursor=conn.cursor()
-    cursor.execute('SELECT * FROM raw_data ORDER BY last_check DESC LIMIT 1')
+    cursor.execute(('SELECT search_json FROM raw_data WHERE last_check = '
+                    '(SELECT MAX(last_check) FROM raw_data) ORDER BY rowid'))
     outdata = cursor.fetchone()
-    if outdata:
-        return json.loads(outdata[1])
-    return None
+    if not outdata:
+        return None
+    out = _decode_snapshot(outdata[0])
+    #Snapshots written page by page are stored as one row per page
+    for page in cursor:
+        out['data']['items'] += _decode_snapshot(page[0])['data']['items']
+    return out
 
-def write_search_data(conn:sqlite3.Connection, last_check:str, search_json:dict)->None:
+def iter_search_data(conn:sqlite3.Connection):
+    '''
+    Generator yielding the individual records from the last harvested
+    search results as records.Study tuples, decoding only one stored
+    page at a time.
+    '''
+    cursor=conn.cursor()
+    cursor.execute(('SELECT search_json FROM raw_data WHERE last_check = '
+                    '(SELECT MAX(last_check) FROM raw_data) ORDER BY rowid'))
+    for page in cursor:
+        for rec in _decode_snapshot(page[0])['data']['items']:
+            yield Study.from_record(rec)
+
+def write_search_data(conn:sqlite3.Connection, last_check:str, search_json,
+                      commit:bool=True, fields:tuple=STUDY_KEYS)->None:
     '''
     Writes the current study search JSON to the database
+
+    search_json may be either the complete search API JSON or a single page
+    of records (ie, a list of items or records.Study tuples). Repeated calls with the same
+    last_check add pages to the same snapshot. Set commit to False to
+    leave the write in the caller's transaction.
+
+    Only the record keys in {fields} are kept (use None to keep everything),
+    and the result is stored zlib compressed.
     '''
+    if not isinstance(search_json, dict):
+        search_json = {'data': {'items': list(search_json)}}
+    search_json = dict(search_json)
+    search_json['data'] = dict(search_json['data'],
+                               items=[{x: rec.get(x) for x in fields} if fields
+                                      else dict(rec) for rec in
+                                      search_json['data']['items']])
     cursor = conn.cursor()
     cursor.execute('INSERT INTO raw_data VALUES (?, ?)',
-                   (last_check, json.dumps(search_json)))
+                   (last_check,
+                    zlib.compress(json.dumps(search_json).encode('utf-8'))))
+    if commit:
+        conn.commit()
+
+def write_run_metrics(conn:sqlite3.Connection, run_start:str, rows:list) -> None:
+    '''
+    Writes the measurements from an update check to the run_metrics table
+
+    run_start : str
+        Timestamp of the start of the check
+    rows : list
+        (metric, labels, value) tuples, as from metrics.Metrics.rows
+    '''
+    cursor = conn.cursor()
+    cursor.executemany('INSERT INTO run_metrics VALUES (?, ?, ?, ?);',
+                       [(run_start, *row) for row in rows])
+    conn.commit()
+
+def prune(conn:sqlite3.Connection, keep_snapshots:int=3, keep_days:float=30,
+          vacuum_ratio:float=0.25) -> tuple:
+    '''
+    Removes old search snapshots, status records, run metrics and
+    completed journal operations, then reclaims the space if enough of the
+    database file is unused. Returns the number of raw_data, status,
+    run_metrics and op_journal rows removed.
+
+    keep_snapshots : int
+        Number of most recent search snapshots to keep
+    keep_days : float
+        Status records older than this many days are removed, unless they
+        belong to a kept snapshot. The latest status record is always kept.
+        Run metrics and completed journal operations older than this
+        are always removed.
+    vacuum_ratio : float
+        VACUUM the database if at least this fraction of its pages are free
+    '''
+    cursor = conn.cursor()
+    cursor.execute(('DELETE FROM raw_data WHERE last_check NOT IN '
+                    '(SELECT DISTINCT last_check FROM raw_data '
+                    'ORDER BY last_check DESC LIMIT ?);'), (max(1, keep_snapshots),))
+    snapshots = cursor.rowcount
+    cursor.execute(('DELETE FROM status WHERE last_check < '
+                    'strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\', ?) '
+                    'AND last_check NOT IN (SELECT last_check FROM raw_data) '
+                    'AND last_check < (SELECT MAX(last_check) FROM status);'),
+                   (f'-{keep_days} days',))
+    statuses = cursor.rowcount
+    cursor.execute(('DELETE FROM run_metrics WHERE run_start < '
+                    'strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\', ?);'),
+                   (f'-{keep_days} days',))
+    run_metrics = cursor.rowcount
+    cursor.execute(('DELETE FROM op_journal WHERE done < '
+                    'strftime(\'%Y-%m-%dT%H:%M:%SZ\', \'now\', ?);'),
+                   (f'-{keep_days} days',))
+    journal = cursor.rowcount
     conn.commit()
+    LOGGER.info('Pruned %s snapshot rows, %s status rows, %s metrics rows '
+                'and %s journal rows', snapshots, statuses, run_metrics, journal)
+    free = cursor.execute('PRAGMA freelist_count;').fetchone()[0]
+    pages = cursor.execute('PRAGMA page_count;').fetchone()[0]
+    if pages and free / pages >= vacuum_ratio:
+        LOGGER.info('Reclaiming %s of %s database pages', free, pages)
+        cursor.execute('VACUUM;')
+    return snapshots, statuses, run_metrics, journal
 
 ##based on time.now() - 1d/1h/10min if no time provided
 
@@ -0,0 +1,163 @@
+'''
+Updating several Dataverse installations from one configuration file.
+
+Each section of the configuration file is an installation. Its keys are
+dv_coll_linker's long command line options, without the leading dashes,
+and options shared by every installation can go in a [DEFAULT] section.
+Options which don't take a value (eg, incremental) are set with true or
+false.
+
+    [DEFAULT]
+    incremental = true
+    workers = 8
+
+    [abacus]
+    url = https://abacus.library.ubc.ca
+    key = xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
+    dbname = ~/links/abacus.sqlite3
+
+    [borealis]
+    url = https://borealisdata.ca
+    key = xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
+
+Every installation is updated in its own worker process, with its own
+link database and run lock, at most {parallel} at a time, so the whole
+run takes about as long as the slowest installation. Unless set, dbname
+defaults to ~/dv_links_{section}.sqlite3 and log to ~/logs/{section}.
+Installations can't share a dbname or log, so neither belongs in
+[DEFAULT].
+'''
+import collections
+import configparser
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from dv_coll_linker import app
+from dv_coll_linker import runlock
+
+LOGGER = logging.getLogger(__name__)
+
+#Values of options which don't take a value
+TRUE = ('true', 'yes', 'on')
+FALSE = ('false', 'no', 'off')
+#Options which make no sense for one installation among many
+EXCLUDED = ('config', 'parallel', 'daemonize', 'interval', 'version', 'help')
+#Summary columns: heading, metrics counters summed
+COLUMNS = (('studies', ('studies_inserted', 'studies_updated')),
+           ('linked', ('links_created', 'links_resumed')),
+           ('unlinked', ('links_removed',)),
+           ('failed', ('links_failed', 'unlinks_failed', 'resume_failed')),
+           ('pending', ('ops_deferred',)))
+
+Result = collections.namedtuple('Result', ['name', 'status', 'seconds', 'counters', 'error'])
+Result.__doc__ = '''
+Outcome of updating one installation.
+
+status
+    'ok', 'failed' or 'locked' (another run was using the link database)
+counters
+    dict of metrics counters from the update check
+error
+    Error message if the update failed
+'''
+
+def read_config(path:str) -> collections.OrderedDict:
+    '''
+    Reads a configuration file, returning an OrderedDict of installation
+    (section) name -> dv_coll_linker command line arguments (a list).
+    Raises ValueError if the file is missing or invalid, or if two
+    installations share a link database or log file.
+    '''
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(os.path.expanduser(path), encoding='utf-8'):
+        raise ValueError(f'Unable to read configuration file {path}')
+    if not config.sections():
+        raise ValueError(f'No installations in {path}')
+    jobs = collections.OrderedDict()
+    #(option, path) -> section using it
+    paths = {}
+    for name in config.sections():
+        section = dict(config[name])
+        section.setdefault('dbname', f'~/dv_links_{name}.sqlite3')
+        section.setdefault('log', os.path.join('~', 'logs', name))
+        argv = []
+        for key, value in section.items():
+            option = key.replace('_', '-')
+            if option in EXCLUDED:
+                raise ValueError(f'[{name}]: {key} can\'t be used in a configuration file')
+            if value.lower() in TRUE:
+                argv.append(f'--{option}')
+            elif value.lower() not in FALSE:
+                argv += [f'--{option}', os.path.expanduser(value)
+                         if option in ('dbname', 'log', 'metrics-file') else value]
+        for option, desc in (('dbname', 'link database'), ('log', 'log file')):
+            path = os.path.abspath(os.path.expanduser(section[option]))
+            if (option, path) in paths:
+                raise ValueError(f'[{name}] and [{paths[(option, path)]}] use the same '
+                                 f'{desc} {path}')
+            paths[(option, path)] = name
+        jobs[name] = argv
+    return jobs
+
+def run_installation(job:tuple) -> Result:
+    '''
+    Performs one update check for a single installation, in a worker
+    process. {job} is a (name, arguments) tuple from read_config. Errors
+    are logged to the installation's own log and returned in the Result.
+    '''
+    name, argv = job
+    start = time.monotonic()
+    try:
+        args = app.argument_parser().parse_args(argv)
+    except SystemExit:
+        return Result(name, 'failed', 0, {}, 'Invalid options (see above)')
+    try:
+        mainlog = app.setup(args)
+        with runlock.RunLock(f'{os.path.expanduser(args.dbname)}.lock', args.lock_wait):
+            mets = app.run(args, mainlog)
+    except runlock.LockedError as err:
+        return Result(name, 'locked', time.monotonic() - start, {}, str(err))
+    except Exception as err: #pylint: disable=broad-except
+        LOGGER.exception('Update of %s failed', name)
+        return Result(name, 'failed', time.monotonic() - start, {}, f'{type(err).__name__}: {err}')
+    return Result(name, 'ok', time.monotonic() - start,
+                  dict(mets.counters) if mets else {}, None)
+
+def summary(results:list, elapsed:float) -> str:
+    '''
+    Returns a table of the results of every installation
+    '''
+    width = max([len('installation')] + [len(x.name) for x in results])
+    lines = [f'{"installation":<{width}} {"status":<7} {"time_s":>8} ' +
+             ' '.join(f'{x[0]:>8}' for x in COLUMNS)]
+    for res in results:
+        lines.append(f'{res.name:<{width}} {res.status:<7} {res.seconds:8.1f} ' +
+                     ' '.join(f'{sum(res.counters.get(y, 0) for y in x[1]):>8}'
+                              for x in COLUMNS))
+    lines.append(f'Wall time {elapsed:.1f} s; {sum(x.seconds for x in results):.1f} s '
+                 'for all installations together')
+    lines += [f'{x.name}: {x.error}' for x in results if x.error]
+    return '\n'.join(lines)
+
+def run_config(path:str, parallel:int=4) -> int:
+    '''
+    Updates every installation in the configuration file at {path}, at
+    most {parallel} at a time, and prints a summary. Returns an exit
+    status: 0 if every update succeeded, otherwise 1.
+    '''
+    try:
+        jobs = read_config(path)
+    except (ValueError, configparser.Error) as err:
+        print(f'dv_coll_linker: {err}', file=sys.stderr)
+        return 1
+    start = time.monotonic()
+    #A new process for each installation, so that logging and state
+    #don't carry over from one to the next
+    with multiprocessing.Pool(processes=max(1, min(parallel, len(jobs))),
+                              maxtasksperchild=1) as pool:
+        results = pool.map(run_installation, jobs.items(), chunksize=1)
+    print(summary(results, time.monotonic() - start))
+    return 0 if all(x.status == 'ok' for x in results) else 1
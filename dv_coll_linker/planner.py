@@ -0,0 +1,78 @@
+'''
+Set-based planning of study level links.
+
+Rather than checking every study against the links table one at a time,
+the planner works out the complete set of links which *should* exist from
+the collection family tree and the studies in each child collection, and
+compares it with the set of links which *do* exist. The difference is a
+LinkPlan, which the application then executes.
+'''
+import collections
+import logging
+import sqlite3
+
+from dv_coll_linker import monitor
+
+LOGGER = logging.getLogger(__name__)
+
+LinkPlan = collections.namedtuple('LinkPlan', ['create', 'remove', 'track', 'untrack'])
+LinkPlan.__doc__ = '''
+Links required to bring a Dataverse installation up to date. Each field
+is a sorted list of (pid, parent, child) tuples.
+
+create
+    Links to create in Dataverse and add to the links table, one for each
+    study and parent collection
+remove
+    Links to remove from Dataverse and from the links table
+track
+    Links which already exist in Dataverse through another child collection,
+    or which will once the link in create for the same study and parent is
+    made, so only need adding to the links table
+untrack
+    Links table rows which are no longer valid, but whose Dataverse link
+    is still required through another child collection
+'''
+
+def plan_links(family_tree:list, index:dict, links:set) -> LinkPlan:
+    '''
+    Returns the LinkPlan which turns {links} into the links required by
+    {family_tree}.
+
+    family_tree : list
+        (parent, child) collection alias pairs, as from
+        monitor.fetch_parent_child_collections
+    index : dict
+        Collection alias -> set of PIDs of studies in that collection,
+        as from monitor.fetch_study_index
+    links : set
+        Existing (pid, parent, child) links, as from monitor.fetch_links
+    '''
+    wanted = {(pid, parent, child) for parent, child in family_tree
+              for pid in index.get(child, ())}
+    #Dataverse links a study to a parent, not to a (parent, child) pair
+    wanted_pairs = {x[:2] for x in wanted}
+    linked_pairs = {x[:2] for x in links}
+    new = wanted - links
+    old = links - wanted
+    #A study reaching a parent through several child collections is linked once
+    create = {}
+    for link in sorted(new):
+        if link[:2] not in linked_pairs:
+            create.setdefault(link[:2], link)
+    create = set(create.values())
+    plan = LinkPlan(create=sorted(create),
+                    remove=sorted(x for x in old if x[:2] not in wanted_pairs),
+                    track=sorted(new - create),
+                    untrack=sorted(x for x in old if x[:2] in wanted_pairs))
+    LOGGER.info('Link plan: %s to create, %s to remove, %s to track, %s to untrack',
+                len(plan.create), len(plan.remove), len(plan.track), len(plan.untrack))
+    return plan
+
+def plan_from_db(conn:sqlite3.Connection) -> LinkPlan:
+    '''
+    Returns the LinkPlan for the current contents of the link database
+    '''
+    family_tree = monitor.fetch_parent_child_collections(conn)
+    index = monitor.fetch_study_index(conn)
+    return plan_links(family_tree, index, monitor.fetch_links(conn))
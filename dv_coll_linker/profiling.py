@@ -0,0 +1,192 @@
+'''
+Profiling of complete runs, for attaching to performance bug reports.
+
+A Profiler runs cProfile over the main thread and every thread started
+while it is active (the harvest and linking worker threads), and can
+optionally sample memory use at each phase boundary. When stopped, it
+writes two files:
+
+* dv_coll_linker-{timestamp}.pstats, for pstats, snakeviz and the like
+* dv_coll_linker-{timestamp}.txt, a plain text summary of the functions
+  taking the most time and any memory samples
+'''
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
+
+LOGGER = logging.getLogger(__name__)
+
+#Number of functions listed in the text summary
+TOP = 40
+#Command line options whose values are not written to the summary
+SECRET = ('-w', '--password', '-k', '--key')
+
+def _secret(arg:str) -> int:
+    '''
+    Returns the index in {arg} at which a secret value starts: len(arg) if
+    the value is the next argument, or -1 if {arg} isn't a secret option.
+    Long options may be abbreviated, as argparse allows, and short options
+    may have the value attached or follow other single letter options.
+    '''
+    name = arg.split('=', 1)[0]
+    if name.startswith('--'):
+        if len(name) > 2 and any(x.startswith(name) for x in SECRET if x.startswith('--')):
+            return len(name) + 1 if '=' in arg else len(arg)
+        return -1
+    if arg.startswith('-'):
+        #May hide values which merely contain the letter; better than leaking
+        short = {x[1] for x in SECRET if not x.startswith('--')}
+        for pos, char in enumerate(arg[1:], 2):
+            if char in short:
+                return pos
+    return -1
+
+def redact(argv:list) -> list:
+    '''
+    Returns a copy of {argv} with passwords and API keys hidden
+    '''
+    out = []
+    hide = False
+    for arg in argv:
+        if hide:
+            out.append('****')
+            hide = False
+            continue
+        pos = _secret(arg)
+        if pos == len(arg):
+            hide = True
+            out.append(arg)
+        elif pos >= 0:
+            out.append(arg[:pos] + '****')
+        else:
+            out.append(arg)
+    return out
+
+def max_rss() -> int:
+    '''
+    Returns the peak resident memory of this process in bytes, or 0 if
+    it isn't available
+    '''
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kB on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Profiler:
+    '''
+    Profiles everything between start and stop.
+
+    outdir : str
+        Directory for the profile files
+    memory : bool
+        Sample memory use whenever mark is called. Tracing memory
+        allocations slows the run down considerably.
+    '''
+    def __init__(self, outdir:str, memory:bool=False):
+        self.outdir = os.path.expanduser(outdir)
+        self.memory = memory
+        self.profile = cProfile.Profile()
+        self.threads = []
+        self.samples = []
+        self.started = None
+        self.lock = threading.Lock()
+
+    def _thread_hook(self, frame, event, arg): #pylint: disable=unused-argument
+        '''
+        threading.setprofile hook giving each new thread its own profile.
+        On Python 3.12+ the main profile already covers every thread.
+        '''
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            return
+        with self.lock:
+            self.threads.append(prof)
+
+    def start(self) -> None:
+        '''
+        Starts profiling
+        '''
+        self.started = time.perf_counter()
+        if self.memory:
+            tracemalloc.start()
+        self.mark('start')
+        threading.setprofile(self._thread_hook)
+        self.profile.enable()
+
+    def mark(self, label:str) -> None:
+        '''
+        Records a memory sample labelled {label}, if memory sampling is on
+        '''
+        if not self.memory:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            self.samples.append((label, time.perf_counter() - self.started,
+                                 current, peak, max_rss()))
+
+    def stop(self) -> tuple:
+        '''
+        Stops profiling and writes the profile files. Returns their paths.
+        '''
+        self.profile.disable()
+        threading.setprofile(None)
+        elapsed = time.perf_counter() - self.started
+        self.mark('stop')
+        if self.memory:
+            tracemalloc.stop()
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            for prof in self.threads:
+                stats.add(prof)
+        os.makedirs(self.outdir, exist_ok=True)
+        base = os.path.join(self.outdir, 'dv_coll_linker-' +
+                            datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+        stats.dump_stats(f'{base}.pstats')
+        with open(f'{base}.txt', 'w', encoding='utf-8') as out:
+            out.write(self.summary(stats, elapsed))
+        LOGGER.info('Profile written to %s.pstats and %s.txt', base, base)
+        return f'{base}.pstats', f'{base}.txt'
+
+    def summary(self, stats:pstats.Stats, elapsed:float) -> str:
+        '''
+        Returns the text summary of a profile
+        '''
+        out = io.StringIO()
+        out.write(f'Command: {" ".join(redact(sys.argv))}\n')
+        out.write(f'Wall time: {elapsed:.3f} s\n')
+        out.write(f'Threads profiled: {len(self.threads) + 1}\n')
+        out.write(f'Peak RSS: {max_rss() / 1024**2:.1f} MiB\n\n')
+        if self.samples:
+            out.write('Memory at phase boundaries (MiB)\n')
+            out.write(f'{"time_s":>9} {"traced":>9} {"peak":>9} {"rss":>9}  label\n')
+            for label, when, current, peak, rss in self.samples:
+                out.write(f'{when:9.3f} {current / 1024**2:9.1f} {peak / 1024**2:9.1f} '
+                          f'{rss / 1024**2:9.1f}  {label}\n')
+            out.write('\n')
+        stats.stream = out
+        for order in ('cumulative', 'tottime'):
+            out.write(f'Top {TOP} functions by {order} time\n')
+            stats.sort_stats(order).print_stats(TOP)
+        return out.getvalue()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,107 @@
+'''
+Compact study records.
+
+A search API record for a dataset carries a couple of dozen fields
+(description, authors, citation HTML and so on), but only five are used to
+track links. Harvested records are projected into Study tuples as soon
+as they are parsed, which uses a fraction of the memory of the original
+dict.
+
+Study records can be read like the search API dicts they replace, so
+functions written for search API records accept either.
+
+An UpdateIndex sorts records by update time once, so that repeated
+"changed since" queries don't have to scan and parse every record.
+'''
+import bisect
+import collections
+
+#A complete update time, used to fill out partial times such as '2022-04'
+FULLTIME = '0000-01-01T00:00:00Z'
+
+class Study(collections.namedtuple('Study', ['global_id', 'identifier_of_dataverse',
+                                             'name', 'createdAt', 'updatedAt'])):
+    '''
+    Immutable, slotted record of a single study. Fields may be accessed as
+    attributes, as keys (rec['global_id'], rec.get('name')) or by position.
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            #Only fields; tuple methods such as count and index aren't keys
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+    def get(self, key:str, default=None):
+        '''
+        As dict.get
+        '''
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def keys(self) -> tuple:
+        '''
+        Field names, allowing Study records to be used as **kwargs
+        '''
+        return self._fields
+
+    @classmethod
+    def from_record(cls, rec):
+        '''
+        Returns a Study from a search API record (dict), or rec itself
+        if it is already a Study
+        '''
+        if isinstance(rec, cls):
+            return rec
+        return cls(*(rec.get(x) for x in cls._fields))
+
+def full_time(when:str) -> str:
+    '''
+    Returns a time string in '%Y-%m-%dT%H:%M:%SZ' format from a whole
+    one or a leading portion of one, eg, '2022' -> '2022-01-01T00:00:00Z'.
+    Raises ValueError if there is less than a year.
+    '''
+    if len(when) < 4:
+        raise ValueError('Insufficient date information')
+    return when + FULLTIME[len(when):]
+
+class UpdateIndex:
+    '''
+    Records sorted by update time, for finding the records changed since
+    a time, or between two times, by binary search.
+
+    Update times are in '%Y-%m-%dT%H:%M:%SZ' format, which sorts in time
+    order, so they are compared as strings rather than parsed. Records
+    without an update time are left out.
+
+    recs : iterable
+        Search API records or Study tuples. If they are already in update
+        time order, sorting them takes linear time.
+    '''
+    def __init__(self, recs=()):
+        self.recs = sorted((x for x in recs if x.get('updatedAt')),
+                           key=lambda x: x.get('updatedAt'))
+        self.times = [x.get('updatedAt') for x in self.recs]
+
+    def __len__(self):
+        return len(self.recs)
+
+    def since(self, when:str) -> list:
+        '''
+        Returns the records updated after {when}, oldest first. {when}
+        may be a partial time (see full_time).
+        '''
+        return self.recs[bisect.bisect_right(self.times, full_time(when)):]
+
+    def between(self, start:str, end:str) -> list:
+        '''
+        Returns the records updated after {start} and no later than
+        {end}, oldest first, so that consecutive windows don't overlap.
+        Either may be a partial time (see full_time).
+        '''
+        return self.recs[bisect.bisect_right(self.times, full_time(start)):
+                         bisect.bisect_right(self.times, full_time(end))]
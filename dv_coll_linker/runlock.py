@@ -0,0 +1,100 @@
+'''
+Exclusive run lock, so that only one dv_coll_linker process uses a link
+database at a time.
+
+If a run started by cron takes longer than the cron interval, the next
+run would otherwise harvest and link the same studies at the same time.
+The lock is an operating system lock on a file next to the database, so
+it is released automatically if the process dies.
+'''
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError: #Windows
+    fcntl = None
+    import msvcrt
+
+LOGGER = logging.getLogger(__name__)
+
+#Seconds between attempts to take a lock held by another process
+POLL = 0.5
+
+class LockedError(RuntimeError):
+    '''
+    Raised when the run lock is held by another process
+    '''
+
+class RunLock:
+    '''
+    Exclusive lock on {path}, which is created if required.
+
+    Use as a context manager, or call acquire and release.
+    '''
+    def __init__(self, path:str, wait:float=0):
+        self.path = os.path.expanduser(path)
+        self.wait = wait
+        self.fil = None
+
+    def _try_lock(self) -> bool:
+        '''
+        Makes a single attempt to take the lock
+        '''
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fil.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.fil.seek(0)
+                msvcrt.locking(self.fil.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def acquire(self, wait:float=None) -> None:
+        '''
+        Takes the lock, waiting up to {wait} seconds (default: as set on
+        creation) for another process to release it. Raises LockedError
+        if it is still held after that.
+        '''
+        wait = self.wait if wait is None else wait
+        self.fil = open(self.path, 'a+', encoding='utf-8') #pylint: disable=consider-using-with
+        deadline = time.monotonic() + wait
+        logged = False
+        while not self._try_lock():
+            if time.monotonic() >= deadline:
+                self.fil.close()
+                self.fil = None
+                raise LockedError(f'{self.path} is locked by another run')
+            if not logged:
+                LOGGER.info('Waiting up to %s s for another run to finish', wait)
+                logged = True
+            time.sleep(min(POLL, max(0, deadline - time.monotonic())))
+        self.fil.seek(0)
+        self.fil.truncate()
+        self.fil.write(f'{os.getpid()}\n')
+        self.fil.flush()
+        LOGGER.debug('Acquired run lock %s', self.path)
+
+    def release(self) -> None:
+        '''
+        Releases the lock
+        '''
+        if self.fil is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.fil.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fil.seek(0)
+            msvcrt.locking(self.fil.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fil.close()
+        self.fil = None
+        LOGGER.debug('Released run lock %s', self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
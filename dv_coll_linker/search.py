@@ -2,12 +2,24 @@
 A theoretical date search for Dataverse installations.
 Inelegant.
 '''
+import collections
+import concurrent.futures
 import datetime
+import itertools
 import logging
+import queue
+import threading
 
 import requests
 
+from dv_coll_linker.records import Study, full_time
+from dv_coll_linker.session import get_session
+
 TIMEFMT ='%Y-%m-%dT%H:%M:%SZ'
+#Date windowed harvesting: the earliest expected dateSort and the
+#largest window which is paged through without being split
+WINDOWSTART = '1900-01-01T00:00:00Z'
+WINDOWSIZE = 1000
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,51 +34,321 @@ LOGGER = logging.getLogger(__name__)
 #CONSOLE_OUT.setFormatter(FORMATTER)
 #LOGGER.addHandler(CONSOLE_OUT)
 
-def get_total_records(baseurl:str = 'https://abacus.library.ubc.ca') -> int:
+def get_total_records(baseurl:str = 'https://abacus.library.ubc.ca',
+                      session:requests.Session=None) -> int:
     '''
     Returns the total number of datasets in the root collection of a
     Dataverse installation (ie, total number of data sets)
+
+    baseurl : str
+        Base url of Dataverse installation
+    session : requests.Session
+        Session to use for the request. Defaults to the shared session
+        from dv_coll_linker.session
     '''
+    if session is None:
+        session = get_session()
     #just getting count, minimum is 1, which is the fastest
-    req = requests.get(f'{baseurl}/api/search?q=*&type=dataset&per_page=1')
+    req = session.get(f'{baseurl}/api/search?q=*&type=dataset&per_page=1')
     req.raise_for_status()
     LOGGER.info('%s total records found', req.json()['data']['total_count'])
     return req.json()['data']['total_count']
 
+def since_filter(since:str) -> dict:
+    '''
+    Returns extra search API parameters limiting results to datasets
+    whose dateSort is at or after {since}, a time string in
+    '%Y-%m-%dT%H:%M:%SZ' format. Returns an empty dict if since is empty.
+
+    dateSort is the release (or creation) date of a dataset's latest major
+    version, so datasets which have only had minor versions, metadata edits
+    or moves between collections since then aren't found.
+    '''
+    if not since:
+        return {}
+    return {'fq': f'dateSort:[{since} TO *]'}
+
+def _get_page(session:requests.Session, baseurl:str, per_page:int,
+              start:int, timeout:int, params:dict=None) -> dict:
+    '''
+    Returns the search API JSON for a single page of datasets. Additional
+    search API parameters (eg, fq) may be supplied in params.
+    '''
+    url = (f'{baseurl}/api/search?q=*&type=dataset&per_page={per_page}'
+           f'&start={start}')
+    page = session.get(url, params=params, timeout=timeout)
+    page.raise_for_status()
+    return page.json()
+
+def _iter_page_json(baseurl:str, per_page:int, timeout:int,
+                    workers:int, session:requests.Session,
+                    params:dict=None):
+    '''
+    Yields the full search API JSON of each page, in order. At most
+    {workers} pages are requested ahead of the consumer, so memory use
+    depends on the page size and not on the size of the installation.
+    '''
+    if session is None:
+        session = get_session()
+    #first page supplies the total count
+    first = _get_page(session, baseurl, per_page, 0, timeout, params)
+    recs = first['data']['total_count']
+    npage = -(-recs // per_page)
+    LOGGER.info('%s total records found', recs)
+    yield first
+
+    starts = iter(range(per_page, npage*per_page, per_page))
+    workers = max(1, workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque(pool.submit(_get_page, session, baseurl,
+                                                per_page, x, timeout, params)
+                                    for x in itertools.islice(starts, workers))
+        page = 1
+        while pending:
+            base_add = pending.popleft().result()
+            nxt = next(starts, None)
+            if nxt is not None:
+                pending.append(pool.submit(_get_page, session, baseurl,
+                                           per_page, nxt, timeout, params))
+            page += 1
+            LOGGER.info('Read page %s of %s', page, npage)
+            yield base_add
+
+def iter_pages(baseurl : str='https://abacus.library.ubc.ca',
+               per_page : int=100,
+               timeout : int=100,
+               workers : int=1,
+               session : requests.Session=None,
+               since : str=None):
+    '''
+    Generator yielding the list of items (ie, the contents of
+    ['data']['items']) from each page of search results for all datasets,
+    as records.Study tuples.
+
+    Arguments are as per get_all_recs, plus:
+
+    since : str
+        If supplied, only datasets released or modified at or after this
+        time ('%Y-%m-%dT%H:%M:%SZ') are returned.
+    '''
+    for page in _iter_page_json(baseurl, per_page, timeout, workers, session,
+                                since_filter(since)):
+        yield [Study.from_record(x) for x in page['data']['items']]
+
+def iter_recs(baseurl : str='https://abacus.library.ubc.ca',
+              per_page : int=100,
+              timeout : int=100,
+              workers : int=1,
+              session : requests.Session=None,
+              since : str=None):
+    '''
+    Generator yielding individual dataset records from the search API as
+    records.Study tuples, in the same order as get_all_recs()['data']['items'],
+    without holding more than a few pages in memory.
+
+    Arguments are as per iter_pages.
+    '''
+    for page in iter_pages(baseurl, per_page, timeout, workers, session, since):
+        yield from page
+
+def _iter_queries(queries:list, baseurl:str, per_page:int, timeout:int,
+                  workers:int, session:requests.Session):
+    '''
+    Generator yielding pages of records.Study tuples for several searches
+    at once. Each element of {queries} is a dict of extra search API
+    parameters, and up to {workers} searches run concurrently, so their
+    pages may be interleaved. Pages pass through a bounded queue, so
+    memory use is limited by the number of workers.
+    '''
+    if session is None:
+        session = get_session()
+    nthreads = min(max(1, workers), len(queries))
+    todo = queue.Queue()
+    for params in queries:
+        todo.put(params)
+    pages = queue.Queue(maxsize=2*max(1, nthreads))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        #Give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def work():
+        try:
+            while not stop.is_set():
+                try:
+                    params = todo.get_nowait()
+                except queue.Empty:
+                    return
+                LOGGER.info('Harvesting %s', params)
+                for page in _iter_page_json(baseurl, per_page, timeout, 1,
+                                            session, params):
+                    put([Study.from_record(x) for x in page['data']['items']])
+        except Exception as err: #pylint: disable=broad-except
+            put(err)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(nthreads)]
+    for thread in threads:
+        thread.start()
+    try:
+        finished = 0
+        while finished < nthreads:
+            item = pages.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+
+def iter_subtree_pages(aliases,
+                       baseurl : str='https://abacus.library.ubc.ca',
+                       per_page : int=100,
+                       timeout : int=100,
+                       workers : int=1,
+                       session : requests.Session=None,
+                       since : str=None):
+    '''
+    Generator yielding the list of items, as records.Study tuples, from
+    each page of search results for the datasets in each collection in
+    {aliases}, including those in their sub-collections. Up to {workers}
+    collections are fetched concurrently, so pages from different
+    collections may be interleaved. A dataset found in more than one of
+    the collections is yielded for each of them.
+
+    aliases : iterable
+        Collection short names
+    Other arguments are as per iter_pages.
+    '''
+    queries = [dict(since_filter(since), subtree=alias) for alias in aliases]
+    yield from _iter_queries(queries, baseurl, per_page, timeout, workers, session)
+
+def window_filter(start:str, end:str) -> dict:
+    '''
+    Returns extra search API parameters limiting results to datasets with
+    start <= dateSort < end. Either may be None for an open ended window.
+    '''
+    return {'fq': f'dateSort:[{start or "*"} TO {end or "*"}}}'}
+
+def date_windows(baseurl : str='https://abacus.library.ubc.ca',
+                 max_size : int=WINDOWSIZE,
+                 timeout : int=100,
+                 workers : int=1,
+                 session : requests.Session=None) -> list:
+    '''
+    Splits all datasets into (start, end) dateSort windows of at most
+    {max_size} datasets, by repeatedly halving any window which is too
+    large. Window counts are requested {workers} at a time. The first
+    window has no start and the last has no end, so that no dataset is
+    left out.
+    '''
+    if session is None:
+        session = get_session()
+    end = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    end = (end + datetime.timedelta(days=1)).strftime(TIMEFMT)
+
+    def count(window):
+        return _get_page(session, baseurl, 1, 0, timeout,
+                         window_filter(*window))['data']['total_count']
+
+    windows = []
+    check = [(None, WINDOWSTART), (WINDOWSTART, end), (end, None)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while check:
+            split = []
+            for window, size in zip(check, pool.map(count, check)):
+                if not size:
+                    continue
+                if size <= max_size or None in window:
+                    windows.append(window)
+                    continue
+                start, stop = (datetime.datetime.strptime(x, TIMEFMT) for x in window)
+                if stop - start <= datetime.timedelta(seconds=1):
+                    #Can't split any further; page through it instead
+                    windows.append(window)
+                    continue
+                middle = (start + (stop - start) / 2).strftime(TIMEFMT)
+                split += [(window[0], middle), (middle, window[1])]
+            check = split
+    windows.sort(key=lambda x: x[0] or '')
+    LOGGER.info('Harvest split into %s date windows', len(windows))
+    return windows
+
+def iter_window_pages(baseurl : str='https://abacus.library.ubc.ca',
+                      per_page : int=100,
+                      timeout : int=100,
+                      workers : int=1,
+                      session : requests.Session=None,
+                      max_size : int=WINDOWSIZE):
+    '''
+    Generator yielding the list of items, as records.Study tuples, from
+    each page of search results for all datasets, like iter_pages. Instead
+    of paging through every dataset with ever deeper start offsets, the
+    datasets are split into dateSort windows of at most {max_size}
+    datasets (see date_windows) which are paged through separately, up to
+    {workers} at a time.
+
+    Datasets appearing in more than one window, such as those published
+    during the harvest, are only yielded once. A warning is logged if fewer
+    datasets are found than the search API reports in total.
+
+    max_size : int
+        Maximum number of datasets in a window
+    Other arguments are as per iter_pages.
+    '''
+    total = get_total_records(baseurl, session)
+    windows = date_windows(baseurl, max_size, timeout, workers, session)
+    seen = set()
+    for page in _iter_queries([window_filter(*x) for x in windows],
+                              baseurl, per_page, timeout, workers, session):
+        page = [x for x in page if x.global_id not in seen]
+        seen.update(x.global_id for x in page)
+        yield page
+    if len(seen) < total:
+        LOGGER.warning('Date windowed harvest found %s of %s records', len(seen), total)
+    else:
+        LOGGER.info('There are %s records', len(seen))
+
 def get_all_recs(baseurl : str='https://abacus.library.ubc.ca',
                  per_page : int=100,
-                 timeout : int=100) -> dict:
+                 timeout : int=100,
+                 workers : int=1,
+                 session : requests.Session=None) -> dict:
     '''
     Returns a single, non-paginated json from the Dataverse search API
     including all datasets (only).
 
+    For large installations, prefer iter_recs, which does not
+    keep the entire result in memory.
+
     baseurl : str
         Base url of Dataverse installation
     per_page : int
         Number of results per page
     timeout  : int
         Request timeout in second
+    workers : int
+        Number of pages to fetch concurrently. Items are returned in
+        the same order regardless of the number of workers.
+    session : requests.Session
+        Session to use for all requests. Defaults to the shared session
+        from dv_coll_linker.session
     '''
-    recs = get_total_records(baseurl)
-    if recs % per_page:
-        npage = int(recs/per_page+1)
-    else:
-        npage = int(recs/per_page)
-
+    pages = _iter_page_json(baseurl, per_page, timeout, workers, session)
     #first page will be added to
-    base = requests.get(f'{baseurl}/api/search?q=*&type=dataset&per_page={per_page}',
-                        timeout=timeout)
-    base.raise_for_status()
-    out = base.json().copy()
-
-    for page in range(1, npage):
-    #for page in range(1, 3):
-        LOGGER.info('Reading page %s of %s', page, npage)
-        url = (f'{baseurl}/api/search?q=*&type=dataset&per_page={per_page}'
-               f'&start={page*per_page}')
-        base_add = requests.get(url, timeout=timeout)
-        base_add.raise_for_status()
-        out['data']['items'] += base_add.json()['data']['items'].copy()
+    out = next(pages)
+    for base_add in pages:
+        out['data']['items'] += base_add['data']['items']
     LOGGER.info('There are %s records', len(out["data"]["items"]))
     return out
 
@@ -79,17 +361,18 @@ def get_new_recs(allrecs:dict, last_check=str) -> list:
 
     last_check is a time string in '%Y-%m-%dT%H:%M:%SZ', or portions thereof. When including the
     time, make sure to use/include T.
+
+    Records are returned in the order they were harvested. Times in this
+    format sort in time order, so they are compared as strings rather than
+    parsed. For repeated queries over the same records, build a
+    records.UpdateIndex once and use its since and between methods, which
+    return records oldest first, instead.
     '''
-    time_string = '0000-01-01T00:00:00Z'
     if len(last_check) < 4:
         LOGGER.error('Insufficient date information')
         raise ValueError('Insufficient date information')
-    if len(last_check) < 20:
-        last_check = last_check + time_string[len(last_check):]
-
-    last = datetime.datetime.strptime(last_check, TIMEFMT)
-    return [x for x in allrecs['data']['items'] if
-            datetime.datetime.strptime(x.get('updatedAt'), TIMEFMT) > last]
+    last = full_time(last_check)
+    return [x for x in allrecs['data']['items'] if (x.get('updatedAt') or '') > last]
 
 if __name__ == '__main__':
     import pickle
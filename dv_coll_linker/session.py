@@ -0,0 +1,286 @@
+'''
+Shared HTTP session for talking to a Dataverse installation.
+
+Bare calls to requests.get and friends open a new connection (and TLS
+handshake) for every request. A full harvest or a large linking run
+makes hundreds or thousands of calls, so the search and linker modules
+use a single pooled requests.Session instead.
+
+Every request made through the session passes through a RequestScheduler,
+which:
+
+* limits the request rate with a token bucket shared by all threads
+* retries throttled (429), unavailable (502, 503, 504) and failed
+  connections, honouring any Retry-After header and otherwise using
+  jittered exponential backoff
+* stops sending requests for a while, via a circuit breaker, once the
+  server has failed repeatedly
+'''
+import email.utils
+import logging
+import random
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from dv_coll_linker import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+POOLSIZE = 10
+RETRY_STATUS = {429, 502, 503, 504}
+
+_SESSION = None
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''
+    Raised instead of sending a request while the circuit breaker is open
+    '''
+
+class TokenBucket:
+    '''
+    Thread safe token bucket allowing {rate} requests per second on average,
+    with bursts of up to {burst} requests. A rate of 0 means no limit.
+    '''
+    def __init__(self, rate:float=0, burst:int=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''
+        Blocks until a request may be sent
+        '''
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    '''
+    Opens after {threshold} consecutive failures, refusing requests for
+    {reset_after} seconds. After that, requests are let through again and
+    the first failure re-opens it.
+    '''
+    def __init__(self, threshold:int=10, reset_after:float=60):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def check(self) -> None:
+        '''
+        Raises CircuitOpenError if requests should not be sent
+        '''
+        with self.lock:
+            if (self.opened is not None and
+                    time.monotonic() - self.opened < self.reset_after):
+                raise CircuitOpenError('Circuit breaker open after '
+                                       f'{self.failures} consecutive failures')
+
+    def success(self) -> None:
+        '''
+        Records a successful request
+        '''
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self) -> None:
+        '''
+        Records a failed request
+        '''
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    LOGGER.error('%s consecutive failures; pausing requests for %s s',
+                                 self.failures, self.reset_after)
+                self.opened = time.monotonic()
+
+def retry_after(response:requests.Response) -> float:
+    '''
+    Returns the delay in seconds requested by a Retry-After header,
+    or None if there isn't one
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, when.timestamp() - time.time())
+
+class RequestScheduler:
+    '''
+    Rate limiting, retry and circuit breaking policy for a session.
+
+    rate : float
+        Average requests per second across all threads. 0 is unlimited
+    burst : int
+        Maximum number of requests sent at once when under the rate
+    retries : int
+        Number of times a throttled or failed request is retried
+    backoff : float
+        Base delay in seconds between retries, doubled on each attempt
+    max_backoff : float
+        Maximum delay in seconds between retries, including pauses
+        requested by the server with Retry-After
+    threshold : int
+        Consecutive failures which open the circuit breaker
+    reset_after : float
+        Seconds for which an open circuit breaker refuses requests
+    '''
+    #pylint: disable=too-many-arguments
+    def __init__(self, rate:float=0, burst:int=1, retries:int=5,
+                 backoff:float=1, max_backoff:float=60,
+                 threshold:int=10, reset_after:float=60):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(threshold, reset_after)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hold_until = 0
+        self.lock = threading.Lock()
+
+    def delay(self, attempt:int) -> float:
+        '''
+        Returns a jittered exponential backoff delay for retry {attempt}
+        '''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def hold(self, seconds:float) -> None:
+        '''
+        Stops all threads from sending requests for {seconds}
+        '''
+        with self.lock:
+            self.hold_until = max(self.hold_until, time.monotonic() + seconds)
+
+    def wait(self) -> None:
+        '''
+        Blocks until a request may be sent
+        '''
+        with self.lock:
+            pause = self.hold_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        self.bucket.acquire()
+
+    def run(self, func, *args, **kwargs) -> requests.Response:
+        '''
+        Calls func(*args, **kwargs), which makes a request and returns a
+        requests.Response, according to the scheduling policy. Returns
+        the last response once retries are exhausted, or re-raises the last
+        connection error. Raises CircuitOpenError, without sending the
+        request, while the circuit breaker is open.
+        '''
+        attempt = 0
+        while True:
+            self.breaker.check()
+            self.wait()
+            try:
+                resp = func(*args, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as err:
+                self.breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                pause = self.delay(attempt)
+                LOGGER.warning('%s; retrying in %.1f s', err, pause)
+                time.sleep(pause)
+            else:
+                if resp.status_code not in RETRY_STATUS:
+                    self.breaker.success()
+                    return resp
+                #Throttling isn't an outage
+                if resp.status_code != 429:
+                    self.breaker.failure()
+                if attempt >= self.retries:
+                    return resp
+                pause = retry_after(resp)
+                if pause is not None:
+                    #Don't let a server stall the run indefinitely
+                    LOGGER.warning('HTTP %s; server requested a %.1f s pause, pausing %.1f s',
+                                   resp.status_code, pause, min(pause, self.max_backoff))
+                    self.hold(min(pause, self.max_backoff))
+                else:
+                    pause = self.delay(attempt)
+                    LOGGER.warning('HTTP %s; retrying in %.1f s',
+                                   resp.status_code, pause)
+                    time.sleep(pause)
+            attempt += 1
+
+class ScheduledSession(requests.Session):
+    '''
+    requests.Session which sends every request through a RequestScheduler.
+
+    If metrics is set to a metrics.Metrics object, the duration of every
+    request sent, including retries, is recorded in it.
+    '''
+    def __init__(self, scheduler:RequestScheduler=None):
+        super().__init__()
+        self.scheduler = scheduler if scheduler else RequestScheduler()
+        self.metrics = None
+
+    def _send(self, method, url, *args, **kwargs) -> requests.Response:
+        '''
+        Sends a single request, timing it if required
+        '''
+        if self.metrics is None:
+            return super().request(method, url, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            self.metrics.observe(metrics.endpoint(url), time.perf_counter() - start)
+
+    def request(self, method, url, *args, **kwargs): #pylint: disable=arguments-differ
+        return self.scheduler.run(self._send, method, url, *args, **kwargs)
+
+def make_session(pool_size:int=POOLSIZE,
+                 scheduler:RequestScheduler=None) -> requests.Session:
+    '''
+    Returns a new ScheduledSession with a connection pool large enough
+    to be shared by pool_size worker threads.
+
+    pool_size : int
+        Maximum number of connections kept open per host
+    scheduler : RequestScheduler
+        Rate limiting and retry policy. Defaults to unlimited
+        requests with retries.
+    '''
+    sess = ScheduledSession(scheduler)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    sess.mount('https://', adapter)
+    sess.mount('http://', adapter)
+    LOGGER.debug('Created session with pool size %s', pool_size)
+    return sess
+
+def get_session() -> requests.Session:
+    '''
+    Returns the module level shared session, creating it on first use.
+    '''
+    global _SESSION #pylint: disable=global-statement
+    if _SESSION is None:
+        _SESSION = make_session()
+    return _SESSION
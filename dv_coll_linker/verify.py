@@ -0,0 +1,167 @@
+'''
+Verification of the links table against the links which actually exist
+in the Dataverse installation.
+
+The links table records the links the linker has made, but links can be
+removed in the Dataverse UI, or made by hand, without the table knowing.
+verify_links asks the installation for the links of every tracked study,
+concurrently, and reports the drift:
+
+missing
+    (pid, parent, child) rows in the links table whose link doesn't
+    exist in Dataverse. Repaired by linking again.
+unexpected
+    (pid, parent) links in Dataverse, to a parent collection managed by
+    the linker, which aren't in the links table. Repaired by adding
+    them to the links table if they are required. Others, such as links
+    made by hand, are only reported, unless pruning unmanaged links is
+    requested, in which case they are unlinked.
+errors
+    PIDs whose links couldn't be read
+'''
+import collections
+import csv
+import logging
+import sqlite3
+
+from dv_coll_linker import linker
+from dv_coll_linker import monitor
+
+LOGGER = logging.getLogger(__name__)
+
+Drift = collections.namedtuple('Drift', ['missing', 'unexpected', 'errors'])
+Drift.__doc__ = '''
+Differences between the links table and Dataverse, as found by
+verify_links. Each field is a sorted list.
+
+missing
+    (pid, parent, child) links table rows not linked in Dataverse
+unexpected
+    (pid, parent) links in Dataverse to a managed parent collection
+    with no links table row
+errors
+    PIDs which couldn't be checked
+'''
+
+def find_drift(links:set, family_tree:list, server:dict) -> Drift:
+    '''
+    Compares the links table with the links found in Dataverse.
+
+    links : set
+        (pid, parent, child) rows, as from monitor.fetch_links
+    family_tree : list
+        (parent, child) collection pairs, as from
+        monitor.fetch_parent_child_collections
+    server : dict
+        pid -> set of linked collection aliases or None, as from
+        linker.batch_get_links
+    '''
+    managed = {x[0] for x in family_tree}
+    pairs = {x[:2] for x in links}
+    missing = sorted(x for x in links
+                     if server.get(x[0]) is not None and x[1] not in server[x[0]])
+    unexpected = sorted((pid, parent) for pid, found in server.items() if found
+                        for parent in found & managed if (pid, parent) not in pairs)
+    errors = sorted(pid for pid, found in server.items() if found is None)
+    return Drift(missing, unexpected, errors)
+
+def repair(conn:sqlite3.Connection, drift:Drift, url:str, key:str,
+           workers:int=4, session=None, recursive:bool=True,
+           prune_unmanaged:bool=False) -> dict:
+    '''
+    Repairs the drift found by find_drift. Returns a dict of
+    link -> action taken: 'relinked', 'tracked', 'unmanaged' (left in
+    place), 'unlinked', 'failed' or 'skipped' (not attempted
+    because the circuit breaker opened).
+
+    conn : sqlite3.Connection
+        Link database connection
+    recursive : bool
+        Studies in sub-collections of linked collections are linked,
+        as per monitor.fetch_study_index
+    prune_unmanaged : bool
+        Unlink unexpected links which aren't required. They weren't made
+        by the linker, so by default they are left alone.
+    '''
+    family_tree = monitor.fetch_parent_child_collections(conn)
+    index = monitor.fetch_study_index(conn, recursive)
+    wanted = {}
+    for parent, child in family_tree:
+        for pid in index.get(child, ()):
+            wanted.setdefault((pid, parent), (pid, parent, child))
+    actions = {}
+    for link, done in linker.batch_link(drift.missing, url, key, workers=workers,
+                                        session=session):
+        actions[link] = 'relinked' if done else 'failed' if done is False else 'skipped'
+    track = [wanted[x] for x in drift.unexpected if x in wanted]
+    monitor.add_links(conn, track)
+    actions.update({x[:2]: 'tracked' for x in track})
+    extra = [x for x in drift.unexpected if x not in wanted]
+    if not prune_unmanaged:
+        actions.update({x: 'unmanaged' for x in extra})
+        extra = []
+    for link, done in linker.batch_unlink(extra, url, key, workers=workers,
+                                          session=session):
+        actions[link] = 'unlinked' if done else 'failed' if done is False else 'skipped'
+    conn.commit()
+    LOGGER.info('Repaired drift: %s', collections.Counter(actions.values()))
+    return actions
+
+def write_report(path:str, drift:Drift, actions:dict=None) -> None:
+    '''
+    Writes a CSV drift report with one row per missing link, unexpected
+    link and error, and the repair action taken, if any.
+    '''
+    actions = actions or {}
+    with open(path, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(['drift', 'pid', 'parent', 'child', 'action'])
+        for pid, parent, child in drift.missing:
+            writer.writerow(['missing', pid, parent, child,
+                             actions.get((pid, parent, child), '')])
+        for pid, parent in drift.unexpected:
+            writer.writerow(['unexpected', pid, parent, '', actions.get((pid, parent), '')])
+        for pid in drift.errors:
+            writer.writerow(['error', pid, '', '', ''])
+    LOGGER.info('Drift report written to %s', path)
+
+def verify_links(conn:sqlite3.Connection, url:str, key:str, workers:int=4,
+                 session=None, fix:bool=False, report:str=None,
+                 recursive:bool=True, prune_unmanaged:bool=False) -> Drift:
+    '''
+    Checks every study in the links table against Dataverse, up to
+    {workers} at a time, and returns the Drift. Each study is only
+    checked once, however many links it has.
+
+    conn : sqlite3.Connection
+        Link database connection
+    url : str
+        Base url to Dataverse installation
+    key : str
+        Superuser API key for Dataverse installation
+    workers : int
+        Maximum number of concurrent requests
+    session : requests.Session
+        Session shared by all requests
+    fix : bool
+        Repair the drift (see repair)
+    report : str
+        If supplied, path of a CSV drift report (see write_report)
+    recursive : bool
+        As per repair
+    prune_unmanaged : bool
+        As per repair
+    '''
+    links = monitor.fetch_links(conn)
+    family_tree = monitor.fetch_parent_child_collections(conn)
+    pids = sorted({x[0] for x in links})
+    LOGGER.info('Verifying links of %s studies', len(pids))
+    server = linker.batch_get_links(pids, url, key, workers=workers, session=session)
+    drift = find_drift(links, family_tree, server)
+    LOGGER.info('Drift: %s missing, %s unexpected, %s errors',
+                len(drift.missing), len(drift.unexpected), len(drift.errors))
+    actions = (repair(conn, drift, url, key, workers, session, recursive, prune_unmanaged)
+               if fix else None)
+    if report:
+        write_report(report, drift, actions)
+    return drift
@@ -59,7 +59,8 @@ CONFIG = {
     'packages': ['dv_coll_linker'],
     'name': 'dv_coll_linker',
     'entry_points':  {'console_scripts': ['dv_coll_linker=dv_coll_linker.app:main']},
-    'package_data': {'dv_coll_linker': ['data/create_tables.sql']}
+    'package_data': {'dv_coll_linker': ['data/create_tables.sql',
+                                        'data/migrations/*.sql']}
 }
 
 setup(**CONFIG)